@@ -3,17 +3,28 @@ from google import genai
 from PIL import Image
 import json
 import os
-import base64
 from datetime import datetime
 import xml.etree.ElementTree as ET
 from dotenv import load_dotenv
 import io
 import pandas as pd
-import fitz  # PyMuPDF
 import subprocess
 import platform
 import shutil
 from pathlib import Path
+import time
+import base64
+import zipfile
+import hashlib
+import tempfile
+
+import extraction
+import worker
+import partner_index
+import prefetch
+import batch_jobs
+import local_extraction
+from page_store import PageStore, PAGE_STORE_MEMORY_MB
 
 # Načtení proměnných prostředí
 load_dotenv()
@@ -50,27 +61,54 @@ API_KEY = os.getenv("GOOGLE_API_KEY")
 if API_KEY:
     client = genai.Client(api_key=API_KEY)
 
+@st.cache_resource(show_spinner=False)
+def get_page_store():
+    """Sdílené úložiště obrazů stránek (jedno pro celý proces Streamlitu)."""
+    store = PageStore()
+    # Úklid stránek po sezeních starších než 30 dní
+    store.purge_older_than(30 * 24 * 3600)
+    return store
+
+@st.cache_resource(show_spinner=False)
+def get_export_dir():
+    """Adresář pro sestavené exporty vedle úložiště stránek (v sezení se drží jen cesta)."""
+    export_dir = page_store.directory.parent / "exports"
+    export_dir.mkdir(exist_ok=True)
+    # Úklid exportů po starých sezeních
+    limit = time.time() - 24 * 3600
+    for path in export_dir.iterdir():
+        try:
+            if path.stat().st_mtime < limit:
+                path.unlink()
+        except OSError:
+            pass
+    return export_dir
+
+@st.cache_resource(show_spinner=False)
+def get_partner_index():
+    """Otevře lokální adresář partnerů, pokud byl sestaven."""
+    if not partner_index.PARTNER_INDEX_DB.exists():
+        return None
+    return partner_index.PartnerIndex()
+
+@st.cache_resource(show_spinner=False)
+def get_prefetch_executor():
+    """Sdílená vlákna pro předběžnou analýzu (počet souběžných volání Gemini je tím omezen)."""
+    return prefetch.create_executor(max_workers=2)
+
+@st.cache_resource(show_spinner=False)
+def get_qr_executor():
+    """Samostatné vlákno pro hledání QR Platby, aby nezdržovalo předběžnou analýzu Gemini."""
+    return prefetch.create_executor(max_workers=1)
+
 @st.cache_data(show_spinner="Dekódování PDF...")
-def pdf_to_images_cached(pdf_name, pdf_size, pdf_bytes):
-    """Převede PDF na seznam obrázků (jeden pro každou stránku) v šedi s využitím cache."""
+def pdf_to_images_cached(pdf_name, pdf_size, pdf_digest, _pdf_file):
+    """Převede PDF na seznam obrázků (jeden pro každou stránku) v šedi s využitím cache.
+    Cache drží jen klíče stránek v úložišti. Soubor (_pdf_file) se nehashuje ani nekopíruje,
+    obsah PDF zastupuje jeho otisk (pdf_digest).
+    """
     try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        pages = []
-        for i in range(len(doc)):
-            page = doc.load_page(i)
-            # Matrix(2, 2) = cca 144 DPI (dostatečné pro OCR, rozumná velikost)
-            # colorspace=fitz.csGRAY = stupně šedi (výrazně zmenší velikost v base64 i v Gemini)
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2), colorspace=fitz.csGRAY)
-            # Uložíme jako JPG s rozumnou kvalitou (oprava parametru na jpg_quality)
-            img_bytes = pix.tobytes("jpg", jpg_quality=85)
-            pages.append({
-                "name": f"{pdf_name}_strana_{i+1}.jpg",
-                "content": img_bytes,
-                "type": "image/jpeg",
-                "id": f"{pdf_name}_p{i+1}_{pdf_size}"
-            })
-        doc.close()
-        return pages
+        return extraction.pdf_to_images(pdf_name, pdf_size, _pdf_file, page_store)
     except Exception as e:
         st.error(f"Chyba při zpracování PDF {pdf_name}: {e}")
         return []
@@ -143,7 +181,7 @@ def run_naps2_scan(company_name):
                 content = f.read()
                 scanned_items.append({
                     "name": f_path.name,
-                    "content": content,
+                    "page": page_store.put(content),
                     "type": "image/jpeg",
                     "id": f"{f_path.name}_{len(content)}"
                 })
@@ -163,154 +201,151 @@ def extract_invoice_data(image_source, mode):
     """Použije Gemini k extrakci strukturovaných dat z obrázku faktury.
     Akceptuje PIL Image nebo bajty.
     """
-    partner_label = "supplier" if mode == "prijata" else "customer"
-    
-    # Pokud dostaneme bajty, převedeme je na PIL Image pro Gemini
-    if isinstance(image_source, bytes):
-        image = Image.open(io.BytesIO(image_source))
-    else:
-        image = image_source
-    
-    prompt = f"""
-    Extract the following information from this invoice image:
-    - invoice_number (string)
-    - variable_symbol (string)
-    - description (string - short summary of what the invoice is for, e.g., "Kancelářské potřeby", "Oprava dveří", max 50 characters)
-    - issue_date (YYYY-MM-DD)
-    - vat_date (YYYY-MM-DD - "Datum zdanitelného plnění" or DUZP. If not found, use null)
-    - due_date (YYYY-MM-DD)
-    - partner_name (string - the name of the {partner_label})
-    - partner_ico (string - the IČO/Registration number of the {partner_label})
-    - partner_vat_id (string - the DIČ/VAT ID of the {partner_label})
-    - base_0 (number - tax exempt amount)
-    - rounding (number - rounding amount)
-    - base_12 (number - tax base for 12% VAT rate)
-    - vat_12 (number - VAT amount for 12% VAT rate)
-    - base_21 (number - tax base for 21% VAT rate)
-    - vat_21 (number - VAT amount for 21% VAT rate)
-    - total_base (number - sum of all tax bases)
-    - total_vat (number - sum of all VAT amounts)
-    - total_amount (number - total including VAT)
-    - currency (string, ISO code e.g., CZK, EUR. Never use "Kč", always use "CZK" for Czech Koruna)
-
-    If a value is not found, return 0 for numeric fields and null for strings.
-    """
-    
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[prompt, image],
-            config={'response_mime_type': 'application/json'}
-        )
-        data = json.loads(response.text)
-        
-        # Očištění polí od mezer (invoice_number, variable_symbol, partner_ico, partner_vat_id)
-        for key in ["invoice_number", "variable_symbol", "partner_ico", "partner_vat_id"]:
-            if data.get(key):
-                data[key] = str(data[key]).replace(" ", "").replace("\xa0", "")
-
-        # Normalizace měny (Gemini občas vrací Kč místo CZK)
-        if data.get("currency") and data["currency"].strip().upper() in ["KČ", "KC"]:
-            data["currency"] = "CZK"
-            
+        return extraction.extract_invoice_data(client, image_source, mode)
+    except Exception as e:
+        st.error(f"Chyba při komunikaci s Gemini: {e}")
+        return None
+
+# Pole zobrazovaná během streamované analýzy (v pořadí, v jakém je model vrací)
+STREAM_FIELD_LABELS = [
+    ("invoice_number", "Číslo faktury"), ("issue_date", "Datum vystavení"),
+    ("variable_symbol", "Variabilní symbol"), ("vat_date", "DUZP"),
+    ("due_date", "Datum splatnosti"), ("description", "Popis"),
+    ("partner_name", "Partner"), ("partner_ico", "IČO"), ("partner_vat_id", "DIČ"),
+    ("base_0", "Základ 0%"), ("rounding", "Zaokrouhlení"),
+    ("base_12", "Základ 12%"), ("vat_12", "DPH 12%"),
+    ("base_21", "Základ 21%"), ("vat_21", "DPH 21%"),
+    ("total_base", "Základ celkem"), ("total_vat", "DPH celkem"),
+    ("total_amount", "Celkem s DPH"), ("currency", "Měna"),
+]
+
+def render_partial_extraction(container, data):
+    """Vykreslí dosud načtená pole streamované analýzy (chybějící jako …)."""
+    lines = []
+    for key, label in STREAM_FIELD_LABELS:
+        value = data.get(key) if key in data else "…"
+        lines.append(f"**{label}:** {value if value is not None else '—'}  ")
+    container.markdown("\n".join(lines))
+
+def extract_invoice_data_streaming(image_source, mode, placeholder):
+    """Jako extract_invoice_data, ale pole vykresluje do placeholderu průběžně, jak přicházejí."""
+    data = None
+    try:
+        for data in extraction.extract_invoice_data_stream(client, image_source, mode):
+            render_partial_extraction(placeholder, data)
         return data
     except Exception as e:
         st.error(f"Chyba při komunikaci s Gemini: {e}")
         return None
 
+def build_invoice_element(data, mode, include_attachments=True, seen_attachments=None):
+    """Vytvoří XML element jedné faktury pro Abra FlexiBee.
+    seen_attachments je volitelná množina klíčů již přiložených obrazů (deduplikace příloh).
+    """
+    invoice = ET.Element("faktura-prijata" if mode == "prijata" else "faktura-vydana")
+    
+    # Očištění polí od mezer pro FlexiBee
+    def clean_val(key):
+        val = data.get(key, "")
+        if val is None: return ""
+        return str(val).replace(" ", "").replace("\xa0", "") # Odstraní i nezalomitelné mezery
+
+    if mode == "prijata":
+        # cisDosle je číslo na papíře od dodavatele
+        inv_num = clean_val("invoice_number") or clean_val("variable_symbol")
+        ET.SubElement(invoice, "cisDosle").text = inv_num
+    else:
+        ET.SubElement(invoice, "kod").text = clean_val("invoice_number")
+        
+    ET.SubElement(invoice, "varSym").text = clean_val("variable_symbol")
+    ET.SubElement(invoice, "datVyst").text = str(data.get("issue_date", ""))
+    
+    # Datum zdanitelného plnění (DUZP) - fallback na datum vystavení
+    duzp = data.get("vat_date") or data.get("issue_date", "")
+    ET.SubElement(invoice, "duzpPuv").text = str(duzp)
+    
+    ET.SubElement(invoice, "datSplat").text = str(data.get("due_date", ""))
+    
+    # Identifikace partnera (FlexiBee dohledá podle IČ/DIČ v adresáři)
+    if data.get("partner_name"):
+        ET.SubElement(invoice, "nazFirmy").text = str(data['partner_name'])
+
+    if data.get("partner_ico"):
+        ET.SubElement(invoice, "ic").text = clean_val("partner_ico")
+    
+    if data.get("partner_vat_id"):
+        ET.SubElement(invoice, "dic").text = clean_val("partner_vat_id")
+    
+    # Popis dokladu - pouze pokud je vyplněn
+    if data.get("description"):
+        ET.SubElement(invoice, "popis").text = str(data["description"])
+     
+    # Tax Exempt + Rounding
+    base_0 = float(data.get("base_0", 0.0)) if data.get("base_0") else 0.0
+    rounding = float(data.get("rounding", 0.0)) if data.get("rounding") else 0.0
+    ET.SubElement(invoice, "sumOsv").text = str(base_0 + rounding)
+
+    # 12% VAT
+    celkem = float(data.get("base_12", 0.0)) if data.get("base_12") else 0.0
+    celkem += float(data.get("vat_12", 0.0)) if data.get("vat_12") else 0.0
+    ET.SubElement(invoice, "sumZklSniz").text = str(data.get("base_12", 0.0)) if data.get("base_12") else "0.0" 
+    ET.SubElement(invoice, "sumDphSniz").text = str(data.get("vat_12", 0.0)) if data.get("vat_12") else "0.0" 
+    ET.SubElement(invoice, "sumCelkSniz").text = str(celkem)
+
+    # 21% VAT
+    celkem = float(data.get("base_21", 0.0)) if data.get("base_21") else 0.0
+    celkem += float(data.get("vat_21", 0.0)) if data.get("vat_21") else 0.0
+    ET.SubElement(invoice, "sumZklZakl").text = str(data.get("base_21", 0.0)) if data.get("base_21") else "0.0" 
+    ET.SubElement(invoice, "sumDphZakl").text = str(data.get("vat_21", 0.0)) if data.get("vat_21") else "0.0" 
+    ET.SubElement(invoice, "sumCelkZakl").text = str(celkem)
+      
+    # Totals
+    ET.SubElement(invoice, "sumZklCelkem").text = str(data.get("total_base", "0"))
+    ET.SubElement(invoice, "sumDphCelkem").text = str(data.get("total_vat", "0"))
+    ET.SubElement(invoice, "sumCelkem").text = str(data.get("total_amount", "0"))
+    
+    # Normalizace měny pro FlexiBee
+    curr_val = data.get('currency', 'CZK')
+    if curr_val and curr_val.strip().upper() in ["KČ", "KC"]:
+        curr_val = "CZK"
+    ET.SubElement(invoice, "mena").text = f"code:{curr_val}"
+    
+    # Typ dokladu musí odpovídat kódu v FlexiBee (FAKTURA je nejvhodnější výchozí)
+    ET.SubElement(invoice, "typDokl").text = "code:FAKTURA"
+
+    # Přiložení originálního obrazu faktury (volitelně)
+    attach_image = include_attachments and bool(data.get("image_page"))
+    # Stejný obraz (např. stránka nahraná i naskenovaná) přikládáme v rámci jednoho XML jen jednou,
+    # klíč stránky je otiskem jejího obsahu
+    if attach_image and seen_attachments is not None:
+        attach_image = data["image_page"] not in seen_attachments
+        seen_attachments.add(data["image_page"])
+    if attach_image:
+        attachments = ET.SubElement(invoice, "prilohy")
+        attachment = ET.SubElement(attachments, "priloha")
+        ET.SubElement(attachment, "nazSoub").text = str(data.get("image_filename", "faktura.jpg"))
+        ET.SubElement(attachment, "contentType").text = str(data.get("image_mimetype", "image/jpeg"))
+        content = ET.SubElement(attachment, "content")
+        content.set("encoding", "base64")
+        content.text = base64.b64encode(page_store.get(data["image_page"])).decode('ascii')
+
+    # Povinne polozky
+    ET.SubElement(invoice, "bezPolozek").text = "true"
+    ET.SubElement(invoice, "szbDphSniz").text = "12.0"
+    ET.SubElement(invoice, "szbDphZakl").text = "21.0"
+
+    return invoice
+
 def generate_flexibee_xml(invoices_list, mode, include_attachments=True):
     """Převede seznam ověřených faktur do formátu Abra FlexiBee XML s hezkým formátováním."""
     from xml.dom import minidom
     
     root = ET.Element("winstrom", version="1.0")
-    tag_name = "faktura-prijata" if mode == "prijata" else "faktura-vydana"
+    seen_attachments = set()
     
     for data in invoices_list:
-        invoice = ET.SubElement(root, tag_name)
-        
-        # Očištění polí od mezer pro FlexiBee
-        def clean_val(key):
-            val = data.get(key, "")
-            if val is None: return ""
-            return str(val).replace(" ", "").replace("\xa0", "") # Odstraní i nezalomitelné mezery
-
-        if mode == "prijata":
-            # cisDosle je číslo na papíře od dodavatele
-            inv_num = clean_val("invoice_number") or clean_val("variable_symbol")
-            ET.SubElement(invoice, "cisDosle").text = inv_num
-        else:
-            ET.SubElement(invoice, "kod").text = clean_val("invoice_number")
-            
-        ET.SubElement(invoice, "varSym").text = clean_val("variable_symbol")
-        ET.SubElement(invoice, "datVyst").text = str(data.get("issue_date", ""))
-        
-        # Datum zdanitelného plnění (DUZP) - fallback na datum vystavení
-        duzp = data.get("vat_date") or data.get("issue_date", "")
-        ET.SubElement(invoice, "duzpPuv").text = str(duzp)
-        
-        ET.SubElement(invoice, "datSplat").text = str(data.get("due_date", ""))
-        
-        # Identifikace partnera (FlexiBee dohledá podle IČ/DIČ v adresáři)
-        if data.get("partner_name"):
-            ET.SubElement(invoice, "nazFirmy").text = str(data['partner_name'])
-
-        if data.get("partner_ico"):
-            ET.SubElement(invoice, "ic").text = clean_val("partner_ico")
-        
-        if data.get("partner_vat_id"):
-            ET.SubElement(invoice, "dic").text = clean_val("partner_vat_id")
-        
-        # Popis dokladu - pouze pokud je vyplněn
-        if data.get("description"):
-            ET.SubElement(invoice, "popis").text = str(data["description"])
-         
-        # Tax Exempt + Rounding
-        base_0 = float(data.get("base_0", 0.0)) if data.get("base_0") else 0.0
-        rounding = float(data.get("rounding", 0.0)) if data.get("rounding") else 0.0
-        ET.SubElement(invoice, "sumOsv").text = str(base_0 + rounding)
-
-        # 12% VAT
-        celkem = float(data.get("base_12", 0.0)) if data.get("base_12") else 0.0
-        celkem += float(data.get("vat_12", 0.0)) if data.get("vat_12") else 0.0
-        ET.SubElement(invoice, "sumZklSniz").text = str(data.get("base_12", 0.0)) if data.get("base_12") else "0.0" 
-        ET.SubElement(invoice, "sumDphSniz").text = str(data.get("vat_12", 0.0)) if data.get("vat_12") else "0.0" 
-        ET.SubElement(invoice, "sumCelkSniz").text = str(celkem)
-    
-        # 21% VAT
-        celkem = float(data.get("base_21", 0.0)) if data.get("base_21") else 0.0
-        celkem += float(data.get("vat_21", 0.0)) if data.get("vat_21") else 0.0
-        ET.SubElement(invoice, "sumZklZakl").text = str(data.get("base_21", 0.0)) if data.get("base_21") else "0.0" 
-        ET.SubElement(invoice, "sumDphZakl").text = str(data.get("vat_21", 0.0)) if data.get("vat_21") else "0.0" 
-        ET.SubElement(invoice, "sumCelkZakl").text = str(celkem)
-          
-        # Totals
-        ET.SubElement(invoice, "sumZklCelkem").text = str(data.get("total_base", "0"))
-        ET.SubElement(invoice, "sumDphCelkem").text = str(data.get("total_vat", "0"))
-        ET.SubElement(invoice, "sumCelkem").text = str(data.get("total_amount", "0"))
-        
-        # Normalizace měny pro FlexiBee
-        curr_val = data.get('currency', 'CZK')
-        if curr_val and curr_val.strip().upper() in ["KČ", "KC"]:
-            curr_val = "CZK"
-        ET.SubElement(invoice, "mena").text = f"code:{curr_val}"
-        
-        # Typ dokladu musí odpovídat kódu v FlexiBee (FAKTURA je nejvhodnější výchozí)
-        ET.SubElement(invoice, "typDokl").text = "code:FAKTURA"
-
-        # Přiložení originálního obrazu faktury (volitelně)
-        if include_attachments and data.get("image_b64"):
-            attachments = ET.SubElement(invoice, "prilohy")
-            attachment = ET.SubElement(attachments, "priloha")
-            ET.SubElement(attachment, "nazSoub").text = str(data.get("image_filename", "faktura.jpg"))
-            ET.SubElement(attachment, "contentType").text = str(data.get("image_mimetype", "image/jpeg"))
-            content = ET.SubElement(attachment, "content")
-            content.set("encoding", "base64")
-            content.text = data.get("image_b64")
-
-        # Povinne polozky
-        ET.SubElement(invoice, "bezPolozek").text = "true"
-        ET.SubElement(invoice, "szbDphSniz").text = "12.0"
-        ET.SubElement(invoice, "szbDphZakl").text = "21.0"
+        root.append(build_invoice_element(data, mode, include_attachments, seen_attachments))
     
     # Převod na řetězec a formátování pomocí minidom
     xml_str = ET.tostring(root, encoding='utf-8')
@@ -319,6 +354,49 @@ def generate_flexibee_xml(invoices_list, mode, include_attachments=True):
     # Navrácení jako bytes pro download_button
     return pretty_xml_str.encode('utf-8')
 
+def write_flexibee_zip(fileobj, invoices_list, mode, max_part_bytes, file_prefix, include_attachments=True):
+    """Zapíše faktury do ZIP archivu jako několik winstrom XML souborů s omezenou velikostí.
+    Faktury se serializují postupně (najednou se sestavuje XML jen jedné faktury).
+    Faktura větší než limit skončí samostatně ve vlastním souboru. Vrací počet souborů.
+    """
+    header = b'<?xml version="1.0" encoding="utf-8"?>\n<winstrom version="1.0">\n'
+    footer = b'</winstrom>\n'
+
+    def invoice_chunk(data, seen_attachments):
+        invoice = build_invoice_element(data, mode, include_attachments, seen_attachments)
+        ET.indent(invoice, space="  ", level=1)
+        return b"  " + ET.tostring(invoice, encoding="utf-8", xml_declaration=False) + b"\n"
+
+    part_count = 0
+    part = None
+    part_size = 0
+    seen_attachments = set()
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for data in invoices_list:
+            chunk = invoice_chunk(data, seen_attachments)
+
+            if part is not None and part_size + len(chunk) + len(footer) > max_part_bytes:
+                part.write(footer)
+                part.close()
+                part = None
+                # Každý soubor se importuje samostatně, deduplikace příloh proto platí jen v rámci souboru
+                seen_attachments = set()
+                chunk = invoice_chunk(data, seen_attachments)
+
+            if part is None:
+                part_count += 1
+                part = zf.open(f"{file_prefix}_part{part_count:03d}.xml", "w")
+                part.write(header)
+                part_size = len(header)
+
+            part.write(chunk)
+            part_size += len(chunk)
+
+        if part is not None:
+            part.write(footer)
+            part.close()
+    return part_count
+
 def check_for_anomalies(invoices_list, mode):
     """Použije Gemini k detekci anomálií v seznamu faktur."""
     if not invoices_list:
@@ -374,7 +452,7 @@ def check_for_anomalies(invoices_list, mode):
     
     try:
         response = client.models.generate_content(
-            model='gemini-2.5-flash',
+            model=extraction.GEMINI_MODEL,
             contents=[prompt, json.dumps(simplified_data, indent=2)],
             config={'response_mime_type': 'application/json'}
         )
@@ -383,8 +461,259 @@ def check_for_anomalies(invoices_list, mode):
         st.error(f"Chyba při kontrole anomálií: {e}")
         return []
 
+def pages_available(pages):
+    """Ověří, že stránky (a vložené ISDOC) nebyly mezitím smazány úklidem úložiště stránek."""
+    return all(page_store.contains(page['page']) and (not page.get('isdoc') or page_store.contains(page['isdoc']))
+               for page in pages)
+
+def pdf_to_images_via_worker(conn, f, pdf_digest):
+    """Zařadí dekódování PDF do fronty workeru. Vrací stránky, nebo None pokud ještě nejsou hotové."""
+    job_id = f"pdf:{f.name}_{f.size}_{pdf_digest}"
+    if job_id in st.session_state.worker_pages:
+        return st.session_state.worker_pages[job_id]
+
+    job = worker.get_jobs(conn, [job_id]).get(job_id)
+    if job is None:
+        worker.enqueue(conn, job_id, "pdf", f.getvalue(), name=f.name, size=f.size)
+        return None
+    if job["status"] == "error":
+        st.error(f"Chyba při zpracování PDF {f.name}: {job['error']}")
+        worker.delete_jobs(conn, [job_id])
+        return []
+    if job["status"] != "done":
+        return None
+
+    pages = job["result"]
+    if not pages_available(pages):
+        # Výsledek starší úlohy odkazuje na smazané stránky, PDF se dekóduje znovu
+        worker.delete_jobs(conn, [job_id])
+        worker.enqueue(conn, job_id, "pdf", f.getvalue(), name=f.name, size=f.size)
+        return None
+    st.session_state.worker_pages[job_id] = pages
+    return pages
+
+def worker_job_id(item, mode):
+    """ID úlohy analýzy ve frontě workeru. Fronta přežívá sezení, proto se úloha
+    váže na obsah stránky, ne na název souboru (skeny z NAPS2 se jmenují stejně).
+    """
+    return item['page'] + mode
+
+def collect_worker_results(conn, items, mode):
+    """Převezme hotové výsledky workeru do extraction_cache.
+    Vrací ID položek, jejichž úlohy jsou ve frontě (čekající nebo zpracovávané).
+    """
+    waiting_jobs = {}
+    for item in items:
+        if (item['id'] + mode) not in st.session_state.extraction_cache:
+            waiting_jobs.setdefault(worker_job_id(item, mode), []).append(item)
+    if not waiting_jobs:
+        return set()
+
+    queued = set()
+    finished = []
+    for job_id, job in worker.get_jobs(conn, waiting_jobs).items():
+        if job["status"] == "done":
+            for item in waiting_jobs[job_id]:
+                store_extraction_result(item, mode, dict(job["result"]))
+        elif job["status"] == "error":
+            st.error(f"Chyba při analýze {waiting_jobs[job_id][0]['name']}: {job['error']}")
+        else:
+            queued.update(item['id'] + mode for item in waiting_jobs[job_id])
+            continue
+        finished.append(job_id)
+    # Převzaté i chybné úlohy smažeme (chybnou analýzu tak lze zopakovat)
+    if finished:
+        worker.delete_jobs(conn, finished)
+    return queued
+
+def store_extraction_result(item, mode, data):
+    """Uloží výsledek extrakce do extraction_cache spolu s odkazem na obraz.
+    Údaje partnera se přitom ověří a doplní z lokálního adresáře (bez volání API).
+    """
+    extraction.attach_item_image(data, item)
+    # Lokálně zjištěné hodnoty (ISDOC, QR Platba) se doplní do výsledku Gemini
+    warnings = []
+    local = st.session_state.local_data.get(item['id'] + mode)
+    if local:
+        warnings = local_extraction.merge_local_data(data, local["data"])
+        data["local_source"] = local["source"]
+    data["partner_check"] = " ".join(warnings + partner_index.check_partner_data(data, get_partner_index()))
+    st.session_state.extraction_cache[item['id'] + mode] = data
+
+def prefetch_extraction(page_key, mode, progress=None, progress_key=None):
+    """Předběžná analýza položky ve vlákně prefetcheru (nesmí volat st.*).
+    Načtením stránky se zároveň ohřeje úložiště stránek pro její zobrazení.
+    Je-li předán slovník progress, analýza se streamuje a průběžná pole
+    se do něj ukládají pod progress_key (UI je zobrazí při dalším dotazu).
+    """
+    image_bytes = page_store.get(page_key)
+    if progress is None:
+        data = extraction.extract_invoice_data(client, image_bytes, mode)
+    else:
+        for data in extraction.extract_invoice_data_stream(client, image_bytes, mode):
+            progress[progress_key] = data
+    return extraction.apply_date_fallbacks(data)
+
+def run_prefetch(items, mode, window_items, conn=None, queued_ids=frozenset()):
+    """Spustí analýzu položek v okně a zruší rozpracované úlohy mimo něj.
+    S workerem se úlohy zařadí do jeho fronty (queued_ids jsou úlohy, které v ní
+    ještě jsou), jinak běží ve vláknech tohoto procesu.
+    Neúspěšné položky se spekulativně neopakují, analýzu lze spustit ručně.
+    Vrací ID položek, jejichž předběžná analýza ještě běží.
+    """
+    window_ids = [item['id'] + mode for item in window_items]
+    if conn is not None:
+        # Úloha prefetche, která z fronty zmizela bez výsledku, selhala (collect_worker_results ji smazal)
+        for item_id in st.session_state.prefetch_jobs - queued_ids:
+            if item_id not in st.session_state.extraction_cache:
+                st.session_state.prefetch_failed.add(item_id)
+        # Zrušíme jen úlohy založené prefetchem, které ještě worker nezačal zpracovávat
+        items_by_id = {item['id'] + mode: item for item in items}
+        stale = [worker_job_id(items_by_id[item_id], mode)
+                 for item_id in st.session_state.prefetch_jobs - set(window_ids) if item_id in items_by_id]
+        if stale:
+            worker.delete_jobs(conn, stale, only_pending=True)
+        running = set()
+        for item, item_id in zip(window_items, window_ids):
+            if item_id in st.session_state.prefetch_failed:
+                continue
+            if item_id not in st.session_state.prefetch_jobs:
+                enqueue_extraction(conn, item, mode, priority=1)
+            elif item_id not in queued_ids:
+                continue
+            running.add(item_id)
+        st.session_state.prefetch_jobs = running
+        return running
+
+    prefetcher = st.session_state.prefetcher
+    prefetcher.cancel_except(window_ids)
+    for item_id in set(st.session_state.extraction_progress) - set(window_ids):
+        st.session_state.extraction_progress.pop(item_id, None)
+    collect_prefetch_results(items, mode)
+    for item, item_id in zip(window_items, window_ids):
+        if item_id not in st.session_state.extraction_cache and item_id not in st.session_state.prefetch_failed:
+            if stream_extraction:
+                prefetcher.schedule(item_id, prefetch_extraction, item['page'], mode,
+                                    st.session_state.extraction_progress, item_id)
+            else:
+                prefetcher.schedule(item_id, prefetch_extraction, item['page'], mode)
+    return prefetcher.pending()
+
+def collect_prefetch_results(items, mode):
+    """Převezme dokončené předběžné analýzy (vlákna tohoto procesu) do extraction_cache.
+    Vrací ID položek, jejichž analýza ještě běží.
+    """
+    prefetcher = st.session_state.prefetcher
+    items_by_id = {item['id'] + mode: item for item in items}
+    for item_id, data, error in prefetcher.pop_finished():
+        st.session_state.extraction_progress.pop(item_id, None)
+        if item_id not in items_by_id or item_id in st.session_state.extraction_cache:
+            continue
+        if error:
+            st.session_state.prefetch_failed.add(item_id)
+            st.error(f"Chyba při předběžné analýze {items_by_id[item_id]['name']}: {error}")
+        elif data:
+            store_extraction_result(items_by_id[item_id], mode, data)
+    return prefetcher.pending()
+
+def scan_qr_platba(page_key, mode):
+    """Hledání QR Platby ve vlákně na pozadí (nesmí volat st.*)."""
+    return local_extraction.extract_qr_data(page_store.get(page_key), mode)
+
+def add_local_data(item, mode, data, source):
+    """Přidá k položce lokálně zjištěná pole (dříve přidaný ISDOC má přednost).
+    Úplná data se převezmou bez volání Gemini. Pokud už výsledek Gemini existuje
+    a položka není schválená, lokální hodnoty se do něj rovnou doplní.
+    """
+    item_id = item['id'] + mode
+    local = st.session_state.local_data.setdefault(item_id, {"data": {}, "source": ""})
+    for key, value in data.items():
+        local["data"].setdefault(key, value)
+    local["source"] = " + ".join(filter(None, [local["source"], source]))
+
+    cached = st.session_state.extraction_cache.get(item_id)
+    if cached is not None:
+        if item_id not in st.session_state.approved_files:
+            warnings = local_extraction.merge_local_data(cached, local["data"])
+            cached["local_source"] = local["source"]
+            cached["partner_check"] = " ".join(filter(None, [cached.get("partner_check")] + warnings))
+    else:
+        local_invoice = local_extraction.local_invoice_data(local["data"])
+        if local_extraction.is_complete(local_invoice):
+            store_extraction_result(item, mode, extraction.apply_date_fallbacks(extraction.normalize_extracted_data(local_invoice)))
+
+def apply_local_extraction(items, mode):
+    """Zkusí u nových položek získat data lokálně (vložený ISDOC, QR Platba).
+    ISDOC se přečte hned (je levný), QR Platba se hledá ve vlákně na pozadí,
+    aby dekódování obrázků neblokovalo UI. Částečná data se doplní do
+    výsledku Gemini ve store_extraction_result.
+    Vrací True, pokud hledání QR Platby ještě běží.
+    """
+    scanner = st.session_state.qr_scanner
+    items_by_id = {item['id'] + mode: item for item in items}
+    for item_id, item in items_by_id.items():
+        if item_id in st.session_state.local_checked:
+            continue
+        st.session_state.local_checked.add(item_id)
+        if item_id in st.session_state.extraction_cache:
+            continue
+        if item.get("isdoc"):
+            try:
+                isdoc_xml = page_store.get(item['isdoc']).decode("utf-8", errors="replace")
+                data = local_extraction.extract_isdoc_data(isdoc_xml, mode)
+            except Exception as e:
+                st.warning(f"Čtení ISDOC z {item['name']} selhalo: {e}")
+                data = {}
+            if data:
+                add_local_data(item, mode, data, "ISDOC")
+        if local_extraction.QR_AVAILABLE and item_id not in st.session_state.extraction_cache:
+            scanner.schedule(item_id, scan_qr_platba, item['page'], mode)
+
+    for item_id, data, error in scanner.pop_finished():
+        if item_id not in items_by_id:
+            continue
+        if error:
+            st.warning(f"Hledání QR Platby v {items_by_id[item_id]['name']} selhalo: {error}")
+        elif data:
+            add_local_data(items_by_id[item_id], mode, data, "QR Platba")
+    return bool(scanner.pending())
+
+def collect_batch_results(conn, items, mode):
+    """Převezme výsledky dokončených dávek do extraction_cache.
+    Vrací ID položek, které na výsledek dávky ještě čekají.
+    """
+    waiting_keys = {}
+    for item in items:
+        if (item['id'] + mode) not in st.session_state.extraction_cache:
+            waiting_keys.setdefault(batch_jobs.item_key(item, mode), []).append(item)
+    if not waiting_keys:
+        return set()
+
+    pending = set()
+    finished = []
+    for key, batch_item in batch_jobs.get_items(conn, waiting_keys).items():
+        if batch_item["status"] == "done":
+            for item in waiting_keys[key]:
+                store_extraction_result(item, mode, dict(batch_item["result"]))
+        elif batch_item["status"] == "error":
+            st.error(f"Chyba dávkové analýzy {waiting_keys[key][0]['name']}: {batch_item['error']}")
+        else:
+            pending.update(item['id'] + mode for item in waiting_keys[key])
+            continue
+        finished.append(key)
+    # Převzaté položky odebereme z evidence, chybné také, aby šly odeslat znovu
+    if finished:
+        batch_jobs.delete_items(conn, finished)
+    return pending
+
+def enqueue_extraction(conn, item, mode, priority=0):
+    """Zařadí analýzu položky do fronty workeru."""
+    worker.enqueue(conn, worker_job_id(item, mode), "extract", page_store.get(item['page']), mode=mode,
+                   name=item['name'], mimetype=item['type'], priority=priority)
+
 # Streamlit UI
 st.set_page_config(page_title="Převod faktur do FlexiBee", layout="wide")
+page_store = get_page_store()
 
 # Kompaktní UI styl (redukce mezer)
 st.markdown("""
@@ -429,9 +758,53 @@ invoice_mode = st.sidebar.radio(
 mode_key = "prijata" if "Přijaté" in invoice_mode else "vydana"
 partner_ui_label = "Dodavatel" if mode_key == "prijata" else "Odběratel/Zákazník"
 
+# Zpracování na pozadí
+st.sidebar.subheader("Zpracování")
+use_worker = st.sidebar.checkbox("Zpracovávat na pozadí (worker)", value=False, help="Analýzu a dekódování PDF provádí samostatný proces `python worker.py`. Dávka pokračuje i po zavření prohlížeče.")
+queue_conn = None
+worker_running = False
+if use_worker:
+    queue_conn = worker.connect()
+    worker_running = worker.worker_alive(queue_conn)
+    if worker_running:
+        st.sidebar.caption("🟢 Worker běží")
+    else:
+        st.sidebar.warning("Worker neběží. Spusťte `python worker.py`, úlohy zatím čekají ve frontě.")
+
+stream_extraction = st.sidebar.checkbox("Průběžně zobrazovat výsledek analýzy", value=True, help="Pole faktury se zobrazují postupně, jak je Gemini vrací, takže kontrolu lze začít dřív.")
+prefetch_count = st.sidebar.number_input("Předběžně analyzovat další položky", min_value=0, max_value=10, value=2, help="Během kontroly se na pozadí analyzuje aktuální a zadaný počet následujících položek. 0 = vypnuto.")
+page_memory_mb = st.sidebar.number_input("Paměť pro obrazy stránek (MB)", min_value=16, max_value=4096, value=PAGE_STORE_MEMORY_MB, help="Stránky nad tento limit zůstávají jen na disku a načítají se při zobrazení.")
+page_store.set_memory_budget(int(page_memory_mb * 1024 * 1024))
+
+# Lokální adresář partnerů (kontrola a doplnění IČO/DIČ)
+st.sidebar.subheader("Adresář partnerů")
+partner_idx = get_partner_index()
+if partner_idx:
+    st.sidebar.caption(f"📇 Index obsahuje {partner_idx.count():,} záznamů".replace(",", " "))
+else:
+    st.sidebar.caption("Index není sestaven, kontroluje se jen kontrolní součet IČO.")
+with st.sidebar.expander("Načíst adresář (CSV/XML)"):
+    registry_files = st.file_uploader("Export z ARES nebo adresáře FlexiBee", type=["csv", "xml"], accept_multiple_files=True)
+    if registry_files and st.button("Sestavit index", use_container_width=True):
+        with st.spinner("Sestavuji index adresáře..."):
+            # Otevřený index je nutné zavřít, jinak ho na Windows nelze nahradit
+            if partner_idx:
+                partner_idx.close()
+            get_partner_index.clear()
+            try:
+                partner_index.build_index([(f, f.name) for f in registry_files])
+                index_built = True
+            except Exception as e:
+                st.error(f"Chyba při sestavení indexu: {e}")
+                index_built = False
+        if index_built:
+            st.rerun()
+
 # Možnosti exportu
 st.sidebar.subheader("Export")
 include_images = st.sidebar.checkbox("Přikládat obrazy faktur do XML", value=True, help="Pokud je vypnuto, XML bude mnohem menší, ale bez náhledů faktur.")
+split_export = st.sidebar.checkbox("Rozdělit export do více XML (ZIP)", value=False, help="Velké exporty s obrazy FlexiBee importuje pomalu nebo vůbec. Faktury se rozdělí do více souborů s omezenou velikostí.")
+max_part_mb = st.sidebar.number_input("Max. velikost jednoho XML (MB)", min_value=1, max_value=500, value=20, disabled=not split_export)
 
 st.title(f"📄 Převodník: Faktury {invoice_mode.split(' ')[0].lower()}")
 
@@ -454,6 +827,29 @@ if "scanned_items" not in st.session_state:
     st.session_state.scanned_items = []
 if "anomalies" not in st.session_state:
     st.session_state.anomalies = {}
+if "worker_pages" not in st.session_state:
+    st.session_state.worker_pages = {}
+if "uploaded_pages" not in st.session_state:
+    st.session_state.uploaded_pages = {}
+if "pdf_digests" not in st.session_state:
+    st.session_state.pdf_digests = {}
+if "prefetcher" not in st.session_state:
+    st.session_state.prefetcher = prefetch.Prefetcher(get_prefetch_executor())
+if "prefetch_jobs" not in st.session_state:
+    st.session_state.prefetch_jobs = set()
+if "prefetch_failed" not in st.session_state:
+    st.session_state.prefetch_failed = set()
+if "extraction_progress" not in st.session_state:
+    st.session_state.extraction_progress = {}
+if "local_checked" not in st.session_state:
+    st.session_state.local_checked = set()
+if "local_data" not in st.session_state:
+    st.session_state.local_data = {}
+if "qr_scanner" not in st.session_state:
+    st.session_state.qr_scanner = prefetch.Prefetcher(get_qr_executor())
+
+# Příznak, že na konci běhu skriptu se má znovu dotázat na výsledky práce na pozadí (worker, prefetch)
+poll_background = False
 
 # Vymazat seznam při změně režimu
 if "last_mode" in st.session_state and st.session_state.last_mode != mode_key:
@@ -463,6 +859,10 @@ if "last_mode" in st.session_state and st.session_state.last_mode != mode_key:
     st.session_state.auto_analyzing = False
     st.session_state.current_file_idx = 0
     st.session_state.anomalies = {}
+    # Lokální data závisí na režimu (partner je dodavatel nebo odběratel)
+    st.session_state.local_checked = set()
+    st.session_state.local_data = {}
+    st.session_state.qr_scanner.cancel_except([])
 st.session_state.last_mode = mode_key
 
 col_up1, col_up2 = st.columns([3, 1])
@@ -494,17 +894,35 @@ processable_items.extend(st.session_state.scanned_items)
 if uploaded_files:
     for f in uploaded_files:
         if f.type == "application/pdf":
-            # Použijeme getvalue() a metadata pro efektivní cachování v RAM
-            pages = pdf_to_images_cached(f.name, f.size, f.getvalue())
+            # Otisk obsahu odliší různá PDF se stejným názvem a velikostí
+            # (počítá se jednou pro každé nahrání, ne při každém běhu skriptu)
+            if f.file_id not in st.session_state.pdf_digests:
+                st.session_state.pdf_digests[f.file_id] = hashlib.sha1(f.getbuffer()).hexdigest()
+            pdf_digest = st.session_state.pdf_digests[f.file_id]
+            if use_worker:
+                pages = pdf_to_images_via_worker(queue_conn, f, pdf_digest)
+                if pages is None:
+                    st.info(f"⏳ {f.name}: PDF se dekóduje na pozadí...")
+                    poll_background = True
+                    continue
+            else:
+                # Cache podle otisku obsahu, PDF se čte jen při prvním dekódování
+                pages = pdf_to_images_cached(f.name, f.size, pdf_digest, f)
+                if not pages_available(pages):
+                    pdf_to_images_cached.clear()
+                    pages = pdf_to_images_cached(f.name, f.size, pdf_digest, f)
             processable_items.extend(pages)
         else:
-            f.seek(0)
-            img_bytes = f.read()
+            upload_id = f"{f.name}_{f.size}"
+            # Obrázek uložíme do úložiště stránek jen jednou, getbuffer() bajty nekopíruje
+            # Klíčem je file_id nahrání, nahrazený soubor se stejným názvem a velikostí se uloží znovu
+            if f.file_id not in st.session_state.uploaded_pages:
+                st.session_state.uploaded_pages[f.file_id] = page_store.put(f.getbuffer())
             processable_items.append({
                 "name": f.name,
-                "content": img_bytes,
+                "page": st.session_state.uploaded_pages[f.file_id],
                 "type": f.type,
-                "id": f"{f.name}_{f.size}"
+                "id": upload_id
             })
 
 if processable_items:
@@ -512,41 +930,114 @@ if processable_items:
         st.session_state.current_file_idx = 0
         st.session_state.last_items_count = len(processable_items)
 
-    # Hromadná analýza - ovládání
-    unprocessed_items = [item for item in processable_items if (item['id'] + mode_key) not in st.session_state.extraction_cache]
+    # Rychlá cesta bez Gemini: vložený ISDOC a QR Platba
+    if apply_local_extraction(processable_items, mode_key):
+        poll_background = True
+
+    # Dávkové (offline) zpracování - kontrola stavu a převzetí hotových výsledků.
+    # Běžící worker stav dávek kontroluje sám, UI pak jen čte lokální databázi.
+    batch_conn = batch_jobs.connect()
+    if not worker_running:
+        for error in batch_jobs.refresh_jobs(batch_conn, client):
+            st.error(f"Chyba dávkového zpracování: {error}")
+    batch_pending_ids = collect_batch_results(batch_conn, processable_items, mode_key)
+
+    # Převzetí výsledků z workeru (i z dávek dokončených při zavřeném UI)
+    queued_ids = set()
+    if use_worker:
+        queued_ids = collect_worker_results(queue_conn, processable_items, mode_key)
+
+    # Předběžná analýza aktuální a následujících položek během ruční kontroly.
+    # Okno se počítá od aktuální položky, po přeskočení jinam se úlohy mimo okno zruší.
+    # Položky odeslané do dávky se interaktivně neanalyzují (platily by se dvakrát).
+    prefetching_ids = set()
+    if not st.session_state.auto_analyzing:
+        window_items = []
+        if prefetch_count:
+            window_items = [item for item in processable_items[st.session_state.current_file_idx:]
+                            if (item['id'] + mode_key) not in st.session_state.extraction_cache
+                            and (item['id'] + mode_key) not in batch_pending_ids][:prefetch_count + 1]
+        prefetching_ids = run_prefetch(processable_items, mode_key, window_items, queue_conn, queued_ids)
+        if prefetching_ids:
+            poll_background = True
+    elif not use_worker:
+        # Během hromadné analýzy se nové úlohy nezakládají, rozpracované ale doběhnou
+        # a jejich výsledky se převezmou (hromadná analýza je nevolá znovu)
+        prefetching_ids = collect_prefetch_results(processable_items, mode_key)
+
+    # Hromadná analýza - ovládání (bez položek čekajících na výsledek dávky)
+    unprocessed_items = [item for item in processable_items
+                         if (item['id'] + mode_key) not in st.session_state.extraction_cache
+                         and (item['id'] + mode_key) not in batch_pending_ids]
     
-    if unprocessed_items:
-        col_auto1, col_auto2 = st.columns([1, 3])
+    if st.session_state.auto_analyzing and not unprocessed_items:
+        st.session_state.auto_analyzing = False
+        st.success("Všechny položky byly analyzovány.")
+
+    if unprocessed_items or batch_pending_ids:
+        col_auto1, col_batch, col_auto2 = st.columns([1, 1, 2])
         if not st.session_state.auto_analyzing:
-            if col_auto1.button(f"🤖 Hromadná analýza ({len(unprocessed_items)})", use_container_width=True):
+            if unprocessed_items and col_auto1.button(f"🤖 Hromadná analýza ({len(unprocessed_items)})", use_container_width=True):
                 st.session_state.auto_analyzing = True
                 st.rerun()
+
+            # Odeslání neanalyzovaných položek do dávky (levnější, výsledky typicky do druhého dne)
+            if unprocessed_items and col_batch.button(f"🌙 Odeslat do dávky ({len(unprocessed_items)})", use_container_width=True, help="Zpracování přes Gemini Batch API za nižší cenu. Výsledky se převezmou automaticky, i po restartu aplikace."):
+                with st.spinner("Odesílám dávku..."):
+                    try:
+                        batch_jobs.submit_batch(batch_conn, batch_jobs.get_backend(client=client), unprocessed_items, mode_key, page_store.get)
+                        batch_submitted = True
+                    except Exception as e:
+                        st.error(f"Chyba při odesílání dávky: {e}")
+                        batch_submitted = False
+                if batch_submitted:
+                    st.rerun()
+            if batch_pending_ids:
+                col_auto2.info(f"🌙 {len(batch_pending_ids)} položek čeká na výsledek dávkového zpracování.")
+                if col_batch.button("🔄 Zkontrolovat dávky", use_container_width=True):
+                    batch_errors = batch_jobs.refresh_jobs(batch_conn, client, force=True)
+                    for error in batch_errors:
+                        st.error(f"Chyba dávkového zpracování: {error}")
+                    if not batch_errors:
+                        st.rerun()
+            if queued_ids:
+                col_auto2.info(f"⏳ Worker zpracovává {len(queued_ids)} položek na pozadí...")
+                poll_background = True
+        elif use_worker:
+            if col_auto1.button("🛑 Zastavit", use_container_width=True):
+                st.session_state.auto_analyzing = False
+                # Čekající úlohy zrušíme, rozpracovanou worker dokončí
+                worker.delete_jobs(queue_conn, [worker_job_id(item, mode_key) for item in unprocessed_items], only_pending=True)
+                st.rerun()
+
+            # Zařazení všech dosud nezařazených položek do fronty workeru
+            for item in unprocessed_items:
+                if (item['id'] + mode_key) not in queued_ids:
+                    enqueue_extraction(queue_conn, item, mode_key)
+            col_auto2.info(f"⏳ Worker zpracovává {len(unprocessed_items)} položek na pozadí...")
+            poll_background = True
         else:
             if col_auto1.button("🛑 Zastavit", use_container_width=True):
                 st.session_state.auto_analyzing = False
                 st.rerun()
             
-            # Provedení jednoho kroku analýzy
-            item = unprocessed_items[0]
-            item_id = item['id'] + mode_key
-            idx_in_all = processable_items.index(item)
-            
-            with st.spinner(f"Analyzuji: {item['name']} ({idx_in_all + 1}/{len(processable_items)})..."):
-                data = extract_invoice_data(item['content'], mode_key)
-                if data:
-                    data["image_b64"] = base64.b64encode(item['content']).decode('utf-8')
-                    data["image_filename"] = item['name']
-                    data["image_mimetype"] = item['type']
-                    # Fallback pro DUZP a Splatnost pokud chybí
-                    if not data.get("vat_date"):
-                        data["vat_date"] = data.get("issue_date")
-                    if not data.get("due_date"):
-                        data["due_date"] = data.get("issue_date")
-                    st.session_state.extraction_cache[item_id] = data
-                st.rerun()
-    elif st.session_state.auto_analyzing:
-        st.session_state.auto_analyzing = False
-        st.success("Všechny položky byly analyzovány.")
+            # Provedení jednoho kroku analýzy (položky s běžící předběžnou analýzou se přeskočí)
+            step_items = [item for item in unprocessed_items if (item['id'] + mode_key) not in prefetching_ids]
+            if not step_items:
+                col_auto2.info("⏳ Čekám na dokončení předběžné analýzy...")
+                poll_background = True
+            else:
+                item = step_items[0]
+                item_id = item['id'] + mode_key
+                idx_in_all = processable_items.index(item)
+
+                with st.spinner(f"Analyzuji: {item['name']} ({idx_in_all + 1}/{len(processable_items)})..."):
+                    data = extract_invoice_data(page_store.get(item['page']), mode_key)
+                    if data:
+                        # Fallback pro DUZP a Splatnost pokud chybí
+                        extraction.apply_date_fallbacks(data)
+                        store_extraction_result(item, mode_key, data)
+                    st.rerun()
 
     # Přehled stavu souborů (dvou-sloupcový seznam)
     with st.expander("📊 Přehled zpracování", expanded=True):
@@ -579,7 +1070,7 @@ if processable_items:
 
     st.divider()
     current_item = processable_items[st.session_state.current_file_idx]
-    image = Image.open(io.BytesIO(current_item['content']))
+    image = Image.open(io.BytesIO(page_store.get(current_item['page'])))
     
     col_img, col_form = st.columns(2)
     with col_img:
@@ -588,19 +1079,33 @@ if processable_items:
     with col_form:
         item_id = current_item['id'] + mode_key
         if item_id not in st.session_state.extraction_cache:
-            if st.button("Analyzovat položku"):
-                with st.spinner("Gemini analyzuje..."):
-                    data = extract_invoice_data(current_item['content'], mode_key)
-                    if data:
-                        data["image_b64"] = base64.b64encode(current_item['content']).decode('utf-8')
-                        data["image_filename"] = current_item['name']
-                        data["image_mimetype"] = current_item['type']
-                        st.session_state.extraction_cache[item_id] = data
-                        st.rerun()
+            if use_worker and item_id in queued_ids:
+                st.info("⏳ Položka čeká na zpracování workerem...")
+            elif item_id in prefetching_ids:
+                st.info("⏳ Položka se analyzuje na pozadí...")
+                if item_id in st.session_state.extraction_progress:
+                    render_partial_extraction(st.container(), st.session_state.extraction_progress[item_id])
+            elif st.button("Analyzovat položku"):
+                if use_worker:
+                    # Ruční analýza předbíhá hromadnou dávku ve frontě
+                    enqueue_extraction(queue_conn, current_item, mode_key, priority=1)
+                    st.rerun()
+                if stream_extraction:
+                    data = extract_invoice_data_streaming(page_store.get(current_item['page']), mode_key, st.empty())
+                else:
+                    with st.spinner("Gemini analyzuje..."):
+                        data = extract_invoice_data(page_store.get(current_item['page']), mode_key)
+                if data:
+                    store_extraction_result(current_item, mode_key, data)
+                    st.rerun()
         
         if item_id in st.session_state.extraction_cache:
             data = st.session_state.extraction_cache[item_id]
             st.subheader(f"Ověření dat ({invoice_mode.split(' ')[0]})")
+            if data.get("local_source"):
+                st.caption(f"⚡ Údaje převzaty lokálně: {data['local_source']}")
+            if data.get("partner_check"):
+                st.warning(f"📇 {data['partner_check']}")
             with st.form(key=f"form_{item_id}"):
                 c1, c2 = st.columns(2)
                 inv_num = c1.text_input("Číslo faktury", data.get("invoice_number"))
@@ -665,10 +1170,12 @@ if processable_items:
                     "total_vat": t_vat,
                     "total_amount": t_amt,
                     "currency": curr,
-                    "image_b64": data.get("image_b64"),
+                    "image_page": data.get("image_page"),
                     "image_filename": data.get("image_filename"),
                     "image_mimetype": data.get("image_mimetype")
                 }
+                # Kontrola ručně upravených údajů partnera (bez automatického doplnění)
+                edited_data["partner_check"] = " ".join(partner_index.check_partner_data(dict(edited_data), get_partner_index()))
                 
                 c_btn1, c_btn2 = st.columns(2)
                 submit = c_btn1.form_submit_button("✅ Schválit a uložit", use_container_width=True)
@@ -743,11 +1250,12 @@ if st.session_state.processed_invoices:
     current_id = processable_items[st.session_state.current_file_idx]['id'] + mode_key
     df['Vybrat'] = df['item_id'] == current_id
     
-    # Přidat sloupec s anomáliemi
-    df['Anomálie'] = df['item_id'].apply(lambda x: st.session_state.anomalies.get(x, ""))
+    # Přidat sloupec s anomáliemi (AI kontrola, jinak výsledek kontroly v adresáři partnerů)
+    partner_checks = df['partner_check'].fillna("") if 'partner_check' in df.columns else pd.Series("", index=df.index)
+    df['Anomálie'] = [st.session_state.anomalies.get(x) or check for x, check in zip(df['item_id'], partner_checks)]
     
     # Skrýt interní ID, technické sloupce a sloupce s nulami
-    cols_to_show = ["Vybrat", "Anomálie"] + [c for c in df.columns if c not in ["image_b64", "image_filename", "image_mimetype", "item_id", "Vybrat", "Anomálie"] + zero_cols]
+    cols_to_show = ["Vybrat", "Anomálie"] + [c for c in df.columns if c not in ["image_page", "image_filename", "image_mimetype", "item_id", "partner_check", "local_source", "Vybrat", "Anomálie"] + zero_cols]
     
     # Použijeme data_editor pro interaktivní checkbox bez duplicitních systémových checkboxů
     edited_df = st.data_editor(
@@ -807,17 +1315,55 @@ if st.session_state.processed_invoices:
                     st.warning(f"Nalezeno {len(anomaly_results)} potenciálních anomálií.")
                 st.rerun()
     with col_exp3:
-        all_xml = generate_flexibee_xml(st.session_state.processed_invoices, mode_key, include_attachments=include_images)
-        save_company_to_history(company_name)
-        
         # Očištění prefixu pro bezpečné jméno souboru
         safe_prefix = "".join([c for c in company_name if c.isalnum() or c in (' ', '-', '_')]).strip().replace(' ', '_')
         if not safe_prefix:
             safe_prefix = "flexibee"
+        export_name = f"{safe_prefix}_{mode_key}_{datetime.now().strftime('%Y%m%d_%H%M')}"
 
-        st.download_button(
-            label=f"⬇️ Stáhnout XML ({invoice_mode.split(' ')[0]})",
-            data=all_xml,
-            file_name=f"{safe_prefix}_{mode_key}_{datetime.now().strftime('%Y%m%d_%H%M')}.xml",
-            mime="application/xml"
-        )
+        # Export se sestavuje jen na vyžádání a drží se, dokud se nezmění faktury nebo nastavení
+        # (sestavení s obrazy je drahé a skript se při práci na pozadí opakuje každou sekundu)
+        export_signature = hashlib.sha1(json.dumps(
+            [st.session_state.processed_invoices, mode_key, include_images, split_export, max_part_mb],
+            sort_keys=True, default=str
+        ).encode("utf-8")).hexdigest()
+        # Sestavený export leží v souboru na disku, v sezení je jen jeho cesta
+        export = st.session_state.get("export")
+        if export is not None and (export["signature"] != export_signature or not Path(export["path"]).exists()):
+            Path(export["path"]).unlink(missing_ok=True)
+            export = st.session_state.export = None
+        if export is None:
+            if st.button("📦 Připravit export", use_container_width=True):
+                save_company_to_history(company_name)
+                with st.spinner("Sestavuji export..."):
+                    suffix = ".zip" if split_export else ".xml"
+                    with tempfile.NamedTemporaryFile("wb", dir=get_export_dir(), suffix=suffix, delete=False) as tmp:
+                        if split_export:
+                            part_count = write_flexibee_zip(tmp, st.session_state.processed_invoices, mode_key,
+                                                            int(max_part_mb * 1024 * 1024), export_name,
+                                                            include_attachments=include_images)
+                            label = f"⬇️ Stáhnout ZIP ({part_count} XML)"
+                        else:
+                            tmp.write(generate_flexibee_xml(st.session_state.processed_invoices, mode_key, include_attachments=include_images))
+                            label = f"⬇️ Stáhnout XML ({invoice_mode.split(' ')[0]})"
+                st.session_state.export = {
+                    "signature": export_signature,
+                    "path": tmp.name,
+                    "label": label,
+                    "file_name": export_name + suffix,
+                    "mime": "application/zip" if split_export else "application/xml"
+                }
+                st.rerun()
+        else:
+            with open(export["path"], "rb") as export_file:
+                st.download_button(
+                    label=export["label"],
+                    data=export_file,
+                    file_name=export["file_name"],
+                    mime=export["mime"]
+                )
+
+# Dotazování fronty workeru až po vykreslení celé stránky, aby UI zůstalo ovladatelné
+if poll_background:
+    time.sleep(1)
+    st.rerun()
@@ -0,0 +1,295 @@
+"""Dávkové (offline) zpracování faktur přes Gemini Batch API.
+
+Neanalyzované položky se zabalí do jedné dávkové úlohy (levnější než
+interaktivní volání a nepodléhá minutovým limitům). Stav úloh i výsledky
+jsou uloženy v SQLite, takže přežijí restart aplikace; hotové výsledky
+si UI převezme do extraction_cache.
+
+Pro testování lze místo Gemini použít lokální náhradní server
+(batch_stub_server.py) nastavením proměnné prostředí BATCH_SERVER_URL.
+
+Kontrola stavu a převzetí výsledků z příkazové řádky:
+    python batch_jobs.py
+"""
+from google import genai
+from dotenv import load_dotenv
+from pathlib import Path
+import urllib.request
+import tempfile
+import sqlite3
+import base64
+import json
+import time
+import os
+
+import extraction
+
+BATCH_JOBS_DB = Path(os.getenv("BATCH_JOBS_DB", "batch_jobs.sqlite3"))
+# Stav dávky se u poskytovatele zjišťuje nejvýše jednou za N sekund
+STATUS_CHECK_INTERVAL = 60
+
+STATE_SUCCEEDED = "JOB_STATE_SUCCEEDED"
+FINISHED_STATES = {STATE_SUCCEEDED, "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def connect(db_path=None):
+    """Otevře (a případně inicializuje) databázi dávkových úloh."""
+    conn = sqlite3.connect(str(db_path or BATCH_JOBS_DB), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            name TEXT PRIMARY KEY,
+            backend TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            state TEXT NOT NULL,
+            error TEXT,
+            created REAL NOT NULL,
+            checked REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS batch_items (
+            item_id TEXT NOT NULL,
+            job_name TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            result TEXT,
+            error TEXT,
+            PRIMARY KEY (item_id, job_name)
+        );
+        CREATE INDEX IF NOT EXISTS batch_items_status ON batch_items (status, item_id);
+    """)
+    return conn
+
+def build_request(image_bytes, mimetype, mode):
+    """Sestaví jeden požadavek dávky (formát řádku JSONL Gemini Batch API)."""
+    return {
+        "contents": [{
+            "role": "user",
+            "parts": [
+                {"text": extraction.build_extraction_prompt(mode)},
+                {"inline_data": {"mime_type": mimetype, "data": base64.b64encode(image_bytes).decode('ascii')}}
+            ]
+        }],
+        "generation_config": {"response_mime_type": "application/json"}
+    }
+
+def response_text(response):
+    """Vytáhne text odpovědi z řádku výsledků (formát GenerateContentResponse)."""
+    candidates = (response or {}).get("candidates") or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+class GeminiBatchBackend:
+    """Dávky přes Gemini Batch API (vstup i výstup jako JSONL soubor)."""
+    kind = "gemini"
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, records, display_name):
+        # JSONL se zapisuje na disk postupně, dávka může mít stovky stránek
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            path = f.name
+        try:
+            uploaded = self.client.files.upload(file=path, config={"display_name": display_name, "mime_type": "jsonl"})
+        finally:
+            os.unlink(path)
+        job = self.client.batches.create(
+            model=extraction.GEMINI_MODEL,
+            src=uploaded.name,
+            config={"display_name": display_name}
+        )
+        return job.name
+
+    def poll(self, name):
+        """Vrátí (stav, řádky výsledků nebo None, chyba)."""
+        job = self.client.batches.get(name=name)
+        state = job.state.name if hasattr(job.state, "name") else str(job.state)
+        error = str(job.error) if getattr(job, "error", None) else None
+        if state != STATE_SUCCEEDED:
+            return state, None, error
+        content = self.client.files.download(file=job.dest.file_name)
+        lines = content.decode("utf-8").splitlines()
+        return state, [json.loads(line) for line in lines if line.strip()], error
+
+class LocalBatchBackend:
+    """Dávky přes lokální náhradní server (batch_stub_server.py) pro testování."""
+    kind = "local"
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def _request(self, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            return resp.read()
+
+    def submit(self, records, display_name):
+        body = self._request("/batches", {"display_name": display_name, "requests": list(records)})
+        return json.loads(body)["name"]
+
+    def poll(self, name):
+        job = json.loads(self._request(f"/{name}"))
+        if job["state"] != STATE_SUCCEEDED:
+            return job["state"], None, job.get("error")
+        lines = self._request(f"/{name}/results").decode("utf-8").splitlines()
+        return job["state"], [json.loads(line) for line in lines if line.strip()], None
+
+def get_backend(kind=None, client=None):
+    """Vrátí backend podle uloženého typu úlohy, případně podle konfigurace prostředí."""
+    server_url = os.getenv("BATCH_SERVER_URL")
+    if kind == "local" or (kind is None and server_url):
+        return LocalBatchBackend(server_url or "http://127.0.0.1:8765")
+    return GeminiBatchBackend(client)
+
+def item_key(item, mode):
+    """Klíč položky v dávce. Evidence dávek přežívá sezení, proto se váže
+    na obsah stránky, ne na název souboru.
+    """
+    return item['page'] + mode
+
+def submit_batch(conn, backend, items, mode, load_page):
+    """Odešle položky [{"page", "type", ...}] jako jednu dávku. Vrací název úlohy.
+    load_page(klíč) vrací bajty stránky (úložiště stránek).
+    Stejná stránka nahraná vícekrát se odešle jen jednou.
+    """
+    items = list({item_key(item, mode): item for item in items}.values())
+    records = (
+        {"key": item_key(item, mode), "request": build_request(load_page(item['page']), item['type'], mode)}
+        for item in items
+    )
+    display_name = f"flexibee_{mode}_{time.strftime('%Y%m%d_%H%M%S')}"
+    name = backend.submit(records, display_name)
+
+    now = time.time()
+    with conn:
+        conn.execute(
+            "INSERT INTO batch_jobs (name, backend, mode, state, created, checked) VALUES (?, ?, ?, ?, ?, ?)",
+            (name, backend.kind, mode, "JOB_STATE_PENDING", now, now)
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO batch_items (item_id, job_name) VALUES (?, ?)",
+            [(item_key(item, mode), name) for item in items]
+        )
+    return name
+
+def _ingest_results(conn, name, lines):
+    """Uloží výsledky dokončené dávky k jednotlivým položkám."""
+    with conn:
+        for line in lines:
+            item_id = line.get("key")
+            try:
+                if line.get("error"):
+                    raise ValueError(json.dumps(line["error"], ensure_ascii=False))
+                data = extraction.normalize_extracted_data(json.loads(response_text(line.get("response"))))
+                conn.execute(
+                    "UPDATE batch_items SET status = 'done', result = ? WHERE item_id = ? AND job_name = ?",
+                    (json.dumps(extraction.apply_date_fallbacks(data), ensure_ascii=False), item_id, name)
+                )
+            except Exception as e:
+                conn.execute(
+                    "UPDATE batch_items SET status = 'error', error = ? WHERE item_id = ? AND job_name = ?",
+                    (str(e), item_id, name)
+                )
+        # Položky, pro které dávka nevrátila žádný řádek
+        conn.execute(
+            "UPDATE batch_items SET status = 'error', error = 'Dávka nevrátila výsledek.' "
+            "WHERE job_name = ? AND status = 'pending'", (name,)
+        )
+
+def refresh_jobs(conn, client=None, force=False):
+    """Zjistí stav nedokončených dávek a převezme výsledky hotových.
+    Vrací seznam chyb (dávky, jejichž stav nešlo zjistit nebo které selhaly).
+    """
+    errors = []
+    now = time.time()
+    jobs = conn.execute(
+        f"SELECT * FROM batch_jobs WHERE state NOT IN ({','.join('?' * len(FINISHED_STATES))})",
+        list(FINISHED_STATES)
+    ).fetchall()
+    for job in jobs:
+        if not force and now - job["checked"] < STATUS_CHECK_INTERVAL:
+            continue
+        try:
+            state, lines, error = get_backend(job["backend"], client).poll(job["name"])
+        except Exception as e:
+            errors.append(f"{job['name']}: {e}")
+            # Nedostupný backend zkusíme znovu až po intervalu, ne při každém dotazu
+            with conn:
+                conn.execute("UPDATE batch_jobs SET checked = ? WHERE name = ?", (now, job["name"]))
+            continue
+
+        if state == STATE_SUCCEEDED:
+            _ingest_results(conn, job["name"], lines)
+        elif state in FINISHED_STATES:
+            errors.append(f"{job['name']}: {state} {error or ''}".strip())
+            with conn:
+                conn.execute(
+                    "UPDATE batch_items SET status = 'error', error = ? WHERE job_name = ? AND status = 'pending'",
+                    (state, job["name"])
+                )
+        with conn:
+            conn.execute(
+                "UPDATE batch_jobs SET state = ?, error = ?, checked = ? WHERE name = ?",
+                (state, error, now, job["name"])
+            )
+    return errors
+
+def get_items(conn, item_ids):
+    """Vrátí stav položek v dávkách jako {item_id: {"status", "result", "error"}}.
+    Hotový výsledek má přednost před čekající nebo chybnou položkou v jiné dávce.
+    """
+    items = {}
+    item_ids = list(item_ids)
+    for start in range(0, len(item_ids), 500):
+        chunk = item_ids[start:start + 500]
+        rows = conn.execute(
+            f"SELECT item_id, status, result, error FROM batch_items WHERE item_id IN ({','.join('?' * len(chunk))})",
+            chunk
+        ).fetchall()
+        for row in rows:
+            current = items.get(row["item_id"])
+            if current and (current["status"] == "done" or row["status"] == "error"):
+                continue
+            items[row["item_id"]] = {
+                "status": row["status"],
+                "result": json.loads(row["result"]) if row["result"] else None,
+                "error": row["error"]
+            }
+    return items
+
+def delete_items(conn, item_ids):
+    """Odebere položky z evidence dávek (převzaté, nebo chybné, aby šly odeslat znovu)."""
+    item_ids = list(item_ids)
+    with conn:
+        for start in range(0, len(item_ids), 500):
+            chunk = item_ids[start:start + 500]
+            conn.execute(f"DELETE FROM batch_items WHERE item_id IN ({','.join('?' * len(chunk))})", chunk)
+
+def list_jobs(conn):
+    """Vrátí přehled dávek s počty položek podle stavu (nejnovější první)."""
+    return conn.execute("""
+        SELECT j.name, j.state, j.created,
+               SUM(i.status = 'pending') AS pending,
+               SUM(i.status = 'done') AS done,
+               SUM(i.status = 'error') AS failed
+        FROM batch_jobs j LEFT JOIN batch_items i ON i.job_name = j.name
+        GROUP BY j.name ORDER BY j.created DESC
+    """).fetchall()
+
+def main():
+    load_dotenv()
+    api_key = os.getenv("GOOGLE_API_KEY")
+    client = genai.Client(api_key=api_key) if api_key else None
+    conn = connect()
+    for error in refresh_jobs(conn, client, force=True):
+        print(f"Chyba: {error}")
+    for job in list_jobs(conn):
+        print(f"{job['name']}: {job['state']} (hotovo {job['done'] or 0}, čeká {job['pending'] or 0}, chyby {job['failed'] or 0})")
+    conn.close()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
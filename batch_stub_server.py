@@ -0,0 +1,104 @@
+"""Lokální náhradní server dávkových úloh pro testování bez Gemini.
+
+Spuštění:
+    python batch_stub_server.py [--port 8765] [--delay 10] [--fixtures adresar]
+
+Aplikace ho použije po nastavení BATCH_SERVER_URL=http://127.0.0.1:8765.
+Dávka postupně přechází stavy PENDING -> RUNNING -> SUCCEEDED (podle --delay).
+Odpovědí je JSON ze souboru <fixtures>/<klíč položky>.json (klíč stránky
+v úložišti + režim), pokud existuje, jinak faktura s prázdnými hodnotami.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import argparse
+import threading
+import json
+import time
+
+EMPTY_INVOICE = {
+    "invoice_number": None, "variable_symbol": None, "description": None,
+    "issue_date": None, "vat_date": None, "due_date": None,
+    "partner_name": None, "partner_ico": None, "partner_vat_id": None,
+    "base_0": 0, "rounding": 0, "base_12": 0, "vat_12": 0, "base_21": 0, "vat_21": 0,
+    "total_base": 0, "total_vat": 0, "total_amount": 0, "currency": "CZK"
+}
+
+class BatchStore:
+    def __init__(self, delay, fixtures):
+        self.delay = delay
+        self.fixtures = Path(fixtures) if fixtures else None
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def create(self, display_name, requests):
+        with self.lock:
+            name = f"batches/{len(self.jobs) + 1}"
+            self.jobs[name] = {"display_name": display_name, "keys": [r["key"] for r in requests], "created": time.time()}
+        return name
+
+    def state(self, name):
+        elapsed = time.time() - self.jobs[name]["created"]
+        if elapsed < self.delay / 2:
+            return "JOB_STATE_PENDING"
+        if elapsed < self.delay:
+            return "JOB_STATE_RUNNING"
+        return "JOB_STATE_SUCCEEDED"
+
+    def response_for(self, key):
+        fixture = self.fixtures / f"{key}.json" if self.fixtures else None
+        data = json.loads(fixture.read_text(encoding="utf-8")) if fixture and fixture.exists() else EMPTY_INVOICE
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": json.dumps(data, ensure_ascii=False)}]}}]}
+
+def make_handler(store):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type="application/json"):
+            payload = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            if self.path != "/batches":
+                return self._send(404, {"error": "not found"})
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            name = store.create(body.get("display_name"), body.get("requests", []))
+            self._send(200, {"name": name, "state": store.state(name)})
+
+        def do_GET(self):
+            path = self.path.lstrip("/")
+            results = path.endswith("/results")
+            name = path[:-len("/results")] if results else path
+            if name not in store.jobs:
+                return self._send(404, {"error": "not found"})
+            state = store.state(name)
+            if not results:
+                return self._send(200, {"name": name, "state": state})
+            if state != "JOB_STATE_SUCCEEDED":
+                return self._send(409, {"error": "job not finished"})
+            lines = [json.dumps({"key": key, "response": store.response_for(key)}, ensure_ascii=False)
+                     for key in store.jobs[name]["keys"]]
+            self._send(200, ("\n".join(lines) + "\n").encode("utf-8"), "application/jsonl")
+
+        def log_message(self, format, *args):
+            print(f"{self.command} {self.path}")
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokální náhradní server dávkových úloh.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=10.0, help="Doba zpracování dávky v sekundách.")
+    parser.add_argument("--fixtures", help="Adresář s odpověďmi <klíč>.json.")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(BatchStore(args.delay, args.fixtures)))
+    print(f"Náhradní dávkový server běží na http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
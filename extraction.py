@@ -0,0 +1,173 @@
+"""Extrakce dat z faktur a dekódování PDF bez závislosti na Streamlitu.
+
+Modul je sdílený mezi UI (app.py) a workerem na pozadí (worker.py),
+proto funkce chyby nezobrazují, ale vyhazují výjimky.
+"""
+from PIL import Image
+import json
+import io
+import fitz  # PyMuPDF
+
+import local_extraction
+
+GEMINI_MODEL = 'gemini-2.5-flash'
+
+def build_extraction_prompt(mode):
+    """Vrátí prompt pro extrakci dat faktury podle typu (přijatá/vydaná)."""
+    partner_label = "supplier" if mode == "prijata" else "customer"
+    return f"""
+    Extract the following information from this invoice image:
+    - invoice_number (string)
+    - variable_symbol (string)
+    - description (string - short summary of what the invoice is for, e.g., "Kancelářské potřeby", "Oprava dveří", max 50 characters)
+    - issue_date (YYYY-MM-DD)
+    - vat_date (YYYY-MM-DD - "Datum zdanitelného plnění" or DUZP. If not found, use null)
+    - due_date (YYYY-MM-DD)
+    - partner_name (string - the name of the {partner_label})
+    - partner_ico (string - the IČO/Registration number of the {partner_label})
+    - partner_vat_id (string - the DIČ/VAT ID of the {partner_label})
+    - base_0 (number - tax exempt amount)
+    - rounding (number - rounding amount)
+    - base_12 (number - tax base for 12% VAT rate)
+    - vat_12 (number - VAT amount for 12% VAT rate)
+    - base_21 (number - tax base for 21% VAT rate)
+    - vat_21 (number - VAT amount for 21% VAT rate)
+    - total_base (number - sum of all tax bases)
+    - total_vat (number - sum of all VAT amounts)
+    - total_amount (number - total including VAT)
+    - currency (string, ISO code e.g., CZK, EUR. Never use "Kč", always use "CZK" for Czech Koruna)
+
+    If a value is not found, return 0 for numeric fields and null for strings.
+    Return the fields in the order listed above.
+    """
+
+def normalize_extracted_data(data):
+    """Očistí hodnoty vrácené modelem (mezery v identifikátorech, měna)."""
+    # Očištění polí od mezer (invoice_number, variable_symbol, partner_ico, partner_vat_id)
+    for key in ["invoice_number", "variable_symbol", "partner_ico", "partner_vat_id"]:
+        if data.get(key):
+            data[key] = str(data[key]).replace(" ", "").replace("\xa0", "")
+
+    # Normalizace měny (Gemini občas vrací Kč místo CZK)
+    if data.get("currency") and data["currency"].strip().upper() in ["KČ", "KC"]:
+        data["currency"] = "CZK"
+
+    return data
+
+def _to_image(image_source):
+    # Pokud dostaneme bajty, převedeme je na PIL Image pro Gemini
+    if isinstance(image_source, bytes):
+        return Image.open(io.BytesIO(image_source))
+    return image_source
+
+def extract_invoice_data(client, image_source, mode):
+    """Použije Gemini k extrakci strukturovaných dat z obrázku faktury.
+    Akceptuje PIL Image nebo bajty. Při chybě vyhodí výjimku.
+    """
+    response = client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=[build_extraction_prompt(mode), _to_image(image_source)],
+        config={'response_mime_type': 'application/json'}
+    )
+    return normalize_extracted_data(json.loads(response.text))
+
+def parse_partial_json(text):
+    """Vrátí pole z neúplného JSON objektu, jejichž hodnota je už celá.
+    Hodnota se považuje za celou, až když za ní následuje čárka nebo konec objektu
+    (číslo na konci bufferu ještě může pokračovat).
+    """
+    decoder = json.JSONDecoder()
+    data = {}
+    pos = text.find("{")
+    if pos == -1:
+        return data
+    pos += 1
+    length = len(text)
+
+    def skip_ws(pos):
+        while pos < length and text[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    while True:
+        pos = skip_ws(pos)
+        if pos >= length or text[pos] != '"':
+            return data
+        try:
+            key, pos = decoder.raw_decode(text, pos)
+            pos = skip_ws(pos)
+            if pos >= length or text[pos] != ":":
+                return data
+            value, pos = decoder.raw_decode(text, skip_ws(pos + 1))
+        except json.JSONDecodeError:
+            return data
+        pos = skip_ws(pos)
+        if pos >= length or text[pos] not in ",}":
+            return data
+        data[key] = value
+        if text[pos] == "}":
+            return data
+        pos += 1
+
+def extract_invoice_data_stream(client, image_source, mode):
+    """Streamovaná varianta extract_invoice_data.
+    Průběžně vrací (yield) slovník s dosud kompletními poli, poslední vrácená
+    hodnota je celý normalizovaný výsledek. Při chybě vyhodí výjimku.
+    """
+    text = ""
+    field_count = 0
+    for chunk in client.models.generate_content_stream(
+        model=GEMINI_MODEL,
+        contents=[build_extraction_prompt(mode), _to_image(image_source)],
+        config={'response_mime_type': 'application/json'}
+    ):
+        text += chunk.text or ""
+        partial = parse_partial_json(text)
+        if len(partial) > field_count:
+            field_count = len(partial)
+            yield normalize_extracted_data(partial)
+    yield normalize_extracted_data(json.loads(text))
+
+def apply_date_fallbacks(data):
+    """Doplní chybějící DUZP a splatnost datem vystavení."""
+    if not data.get("vat_date"):
+        data["vat_date"] = data.get("issue_date")
+    if not data.get("due_date"):
+        data["due_date"] = data.get("issue_date")
+    return data
+
+def attach_item_image(data, item):
+    """Přidá k extrahovaným datům odkaz na originální obraz položky (pro přílohu v XML)."""
+    data["image_page"] = item['page']
+    data["image_filename"] = item['name']
+    data["image_mimetype"] = item['type']
+    return data
+
+def pdf_to_images(pdf_name, pdf_size, pdf_source, store):
+    """Převede PDF na seznam stránek v šedi. Obrazy stránek ukládá do store (PageStore),
+    položky obsahují jen klíč stránky. pdf_source jsou bajty nebo soubor (BytesIO).
+    Pokud PDF obsahuje vložený ISDOC, uloží se jeho XML také do store a první
+    stránka dostane jeho klíč (isdoc).
+    """
+    doc = fitz.open(stream=pdf_source, filetype="pdf")
+    pages = []
+    try:
+        isdoc_xml = local_extraction.find_embedded_isdoc(doc)
+        for i in range(len(doc)):
+            page = doc.load_page(i)
+            # Matrix(2, 2) = cca 144 DPI (dostatečné pro OCR, rozumná velikost)
+            # colorspace=fitz.csGRAY = stupně šedi (výrazně zmenší velikost v base64 i v Gemini)
+            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2), colorspace=fitz.csGRAY)
+            # Uložíme jako JPG s rozumnou kvalitou (oprava parametru na jpg_quality)
+            img_bytes = pix.tobytes("jpg", jpg_quality=85)
+            pages.append({
+                "name": f"{pdf_name}_strana_{i+1}.jpg",
+                "page": store.put(img_bytes),
+                "type": "image/jpeg",
+                "id": f"{pdf_name}_p{i+1}_{pdf_size}"
+            })
+        if isdoc_xml and pages:
+            pages[0]["isdoc"] = store.put(isdoc_xml.encode("utf-8"))
+    finally:
+        doc.close()
+    return pages
@@ -0,0 +1,227 @@
+"""Lokální extrakce strukturovaných dat bez volání Gemini.
+
+- ISDOC: český formát elektronické faktury, často přiložený v PDF jako
+  vložený soubor (.isdoc, případně .isdocx = ZIP s .isdoc uvnitř).
+- QR Platba (SPAYD): QR kód s částkou, VS, splatností a účtem příjemce.
+
+Výsledkem je slovník se stejnými klíči jako u extract_invoice_data.
+Dekódování QR kódů vyžaduje volitelný balíček opencv-python-headless,
+bez něj se používá jen ISDOC. Hledání QR kódu je výrazně pomalejší než
+čtení ISDOC, UI ho proto spouští na pozadí.
+"""
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+import zipfile
+import io
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+QR_AVAILABLE = cv2 is not None
+
+# Pole, bez kterých nelze fakturu převzít bez Gemini
+REQUIRED_FIELDS = ["invoice_number", "issue_date", "total_amount", "currency"]
+
+# Pole QR Platby, která jen doplňují chybějící hodnotu: AM je částka k úhradě
+# (po odečtení záloh a zaokrouhlení), RN je zkrácený název majitele účtu
+QR_FILL_FIELDS = {"qr_amount": "total_amount", "qr_recipient": "partner_name"}
+
+def find_embedded_isdoc(doc):
+    """Najde v otevřeném PDF (fitz.Document) vložený ISDOC a vrátí jeho XML jako text, jinak None."""
+    candidates = []
+    for i in range(doc.embfile_count()):
+        info = doc.embfile_info(i)
+        candidates.append((info.get("filename") or info.get("name") or "", lambda i=i: doc.embfile_get(i)))
+    # Přílohy mohou být vložené i jako anotace stránek
+    for page in doc:
+        for annot in page.annots() or []:
+            if annot.type[1] == "FileAttachment":
+                candidates.append((annot.file_info.get("filename", ""), annot.get_file))
+
+    for filename, read in candidates:
+        name = filename.lower()
+        if not name.endswith((".isdoc", ".isdocx", ".xml")):
+            continue
+        try:
+            content = read()
+            if name.endswith(".isdocx"):
+                with zipfile.ZipFile(io.BytesIO(content)) as zf:
+                    inner = next((n for n in zf.namelist() if n.lower().endswith(".isdoc")), None)
+                    if not inner:
+                        continue
+                    content = zf.read(inner)
+            root = ET.fromstring(content)
+        except Exception:
+            continue
+        if _local_name(root.tag) == "Invoice" and "isdoc" in root.tag.lower():
+            return content.decode("utf-8", errors="replace")
+    return None
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def _child(elem, *path):
+    """Najde potomka podle cesty lokálních jmen (ISDOC má více verzí jmenného prostoru)."""
+    for name in path:
+        if elem is None:
+            return None
+        elem = next((c for c in elem if _local_name(c.tag) == name), None)
+    return elem
+
+def _children(elem, name):
+    return [c for c in (elem if elem is not None else []) if _local_name(c.tag) == name]
+
+def _text(elem, *path):
+    found = _child(elem, *path)
+    if found is None or found.text is None:
+        return None
+    return found.text.strip() or None
+
+def _amount(elem, *path):
+    value = _text(elem, *path)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def parse_isdoc(xml_text, mode):
+    """Převede ISDOC fakturu na pole extract_invoice_data. Partnerem je dodavatel
+    (přijaté faktury) nebo odběratel (vydané faktury). U faktury v cizí měně
+    se použijí částky v této měně (elementy s příponou Curr).
+    """
+    root = ET.fromstring(xml_text.encode("utf-8"))
+    foreign_currency = _text(root, "ForeignCurrencyCode")
+    curr = "Curr" if foreign_currency else ""
+    data = {
+        "invoice_number": _text(root, "ID"),
+        "issue_date": _text(root, "IssueDate"),
+        "vat_date": _text(root, "TaxPointDate"),
+        "currency": foreign_currency or _text(root, "LocalCurrencyCode"),
+    }
+
+    party = _child(root, "AccountingSupplierParty" if mode == "prijata" else "AccountingCustomerParty", "Party")
+    data["partner_name"] = _text(party, "PartyName", "Name")
+    data["partner_ico"] = _text(party, "PartyIdentification", "ID")
+    data["partner_vat_id"] = _text(party, "PartyTaxScheme", "CompanyID")
+
+    details = _child(root, "PaymentMeans", "Payment", "Details")
+    data["due_date"] = _text(details, "PaymentDueDate")
+    data["variable_symbol"] = _text(details, "VariableSymbol")
+
+    # Rozpis DPH podle sazeb (snížené sazby ukládáme do polí pro 12 %)
+    subtotals = _children(_child(root, "TaxTotal"), "TaxSubTotal")
+    base_0 = base_12 = vat_12 = base_21 = vat_21 = 0.0
+    for subtotal in subtotals:
+        percent = _amount(subtotal, "TaxCategory", "Percent") or 0.0
+        base = _amount(subtotal, "TaxableAmount" + curr) or 0.0
+        vat = _amount(subtotal, "TaxAmount" + curr) or 0.0
+        if percent == 0:
+            base_0 += base
+        elif percent >= 21:
+            base_21 += base
+            vat_21 += vat
+        else:
+            base_12 += base
+            vat_12 += vat
+    if subtotals:
+        data.update({"base_0": base_0, "base_12": base_12, "vat_12": vat_12, "base_21": base_21, "vat_21": vat_21})
+
+    totals = _child(root, "LegalMonetaryTotal")
+    data["total_base"] = _amount(totals, "TaxExclusiveAmount" + curr)
+    data["total_amount"] = _amount(totals, "TaxInclusiveAmount" + curr)
+    if data["total_base"] is not None and data["total_amount"] is not None:
+        data["total_vat"] = round(data["total_amount"] - data["total_base"], 2)
+    data["rounding"] = _amount(totals, "PayableRoundingAmount" + curr)
+
+    description = _text(root, "InvoiceLines", "InvoiceLine", "Item", "Description") or _text(root, "Note")
+    if description:
+        data["description"] = description[:50]
+
+    return {key: value for key, value in data.items() if value is not None}
+
+def parse_spayd(text, mode):
+    """Převede řetězec QR Platby (SPD*1.0*ACC:...*AM:...) na pole extract_invoice_data."""
+    if not text or not text.startswith("SPD*"):
+        return {}
+    fields = {}
+    for part in text.split("*")[2:]:
+        key, sep, value = part.partition(":")
+        if sep:
+            fields[key.upper()] = unquote(value)
+
+    data = {}
+    if fields.get("AM"):
+        try:
+            data["qr_amount"] = float(fields["AM"])
+        except ValueError:
+            pass
+    if fields.get("CC"):
+        data["currency"] = fields["CC"].upper()
+    if fields.get("X-VS"):
+        data["variable_symbol"] = fields["X-VS"]
+    dt = fields.get("DT", "")
+    if len(dt) == 8 and dt.isdigit():
+        data["due_date"] = f"{dt[:4]}-{dt[4:6]}-{dt[6:]}"
+    # Příjemce platby je dodavatel; u vydaných faktur jde o nás, ne o partnera
+    if fields.get("RN") and mode == "prijata":
+        data["qr_recipient"] = fields["RN"]
+    return data
+
+def decode_qr_platba(image_bytes):
+    """Najde na obrázku QR Platbu a vrátí její text, jinak None (i bez OpenCV)."""
+    if cv2 is None:
+        return None
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    ok, texts, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(image)
+    if not ok:
+        return None
+    return next((text for text in texts if text.startswith("SPD*")), None)
+
+def extract_isdoc_data(isdoc_xml, mode):
+    """Vrátí pole z ISDOC, nebo prázdný slovník pro nečitelné XML."""
+    try:
+        return parse_isdoc(isdoc_xml, mode)
+    except ET.ParseError:
+        return {}
+
+def extract_qr_data(image_bytes, mode):
+    """Vrátí pole z QR Platby na obrázku stránky (prázdný slovník, pokud tam není)."""
+    return parse_spayd(decode_qr_platba(image_bytes), mode)
+
+def is_complete(data):
+    """Zjistí, zda lokální data stačí k převzetí faktury bez volání Gemini."""
+    return all(data.get(key) for key in REQUIRED_FIELDS) and bool(data.get("partner_ico") or data.get("partner_name"))
+
+def merge_local_data(data, local_data):
+    """Doplní do výsledku Gemini lokálně zjištěné hodnoty. Údaje z ISDOC a VS,
+    splatnost a měna z QR Platby mají přednost; částka a příjemce z QR Platby
+    jen doplní chybějící pole. Vrací seznam upozornění pro uživatele.
+    """
+    warnings = []
+    for key, value in local_data.items():
+        if value in (None, ""):
+            continue
+        target = QR_FILL_FIELDS.get(key)
+        if target is None:
+            data[key] = value
+        elif not data.get(target):
+            data[target] = value
+        elif key == "qr_amount":
+            try:
+                total = float(data[target])
+            except (TypeError, ValueError):
+                continue
+            if abs(total - value) > 0.01:
+                warnings.append(f"Částka k úhradě v QR Platbě ({value:.2f}) se liší od celkové částky ({total:.2f}).")
+    return warnings
+
+def local_invoice_data(local_data):
+    """Sestaví výsledek extrakce jen z lokálně zjištěných hodnot."""
+    data = {}
+    merge_local_data(data, local_data)
+    return data
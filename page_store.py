@@ -0,0 +1,102 @@
+"""Úložiště obrazů stránek na disku s omezenou pamětí.
+
+Položky v session_state drží místo bajtů jen klíč stránky (SHA-1 obsahu).
+Bajty leží v adresáři na disku; naposledy použité stránky se drží
+v paměti (LRU) do nastaveného rozpočtu.
+"""
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import os
+import threading
+import time
+
+PAGE_STORE_DIR = Path(os.getenv("PAGE_STORE_DIR", "page_store"))
+PAGE_STORE_MEMORY_MB = int(os.getenv("PAGE_STORE_MEMORY_MB", "128"))
+
+class PageStore:
+    """Content-addressed úložiště stránek s LRU cache v paměti."""
+
+    def __init__(self, directory=PAGE_STORE_DIR, memory_budget=PAGE_STORE_MEMORY_MB * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.memory_budget = memory_budget
+        self._hot = OrderedDict()
+        self._hot_bytes = 0
+        # Store sdílí všechna sezení Streamlitu (běží v různých vláknech)
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        # Dvouúrovňové rozdělení, aby jeden adresář neobsahoval statisíce souborů
+        return self.directory / key[:2] / key
+
+    def put(self, content):
+        """Uloží bajty stránky (bytes nebo memoryview) a vrátí jejich klíč."""
+        key = hashlib.sha1(content).hexdigest()
+        path = self._path(key)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # Zápis přes dočasný soubor, aby souběžný čtenář neviděl nedopsanou stránku
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        else:
+            # Znovu použitá stránka nesmí být smazána úklidem podle stáří
+            os.utime(path)
+        self._remember(key, bytes(content))
+        return key
+
+    def get(self, key):
+        """Vrátí bajty stránky. Při výpadku z LRU je načte z disku."""
+        with self._lock:
+            content = self._hot.get(key)
+            if content is not None:
+                self._hot.move_to_end(key)
+                return content
+
+        with open(self._path(key), "rb") as f:
+            content = f.read()
+        self._remember(key, content)
+        return content
+
+    def contains(self, key):
+        return self._path(key).exists()
+
+    def set_memory_budget(self, memory_budget):
+        """Změní rozpočet paměti a případně uvolní nejstarší stránky."""
+        with self._lock:
+            self.memory_budget = memory_budget
+            self._evict()
+
+    def memory_usage(self):
+        """Vrátí (počet stránek v paměti, obsazené bajty)."""
+        with self._lock:
+            return len(self._hot), self._hot_bytes
+
+    def purge_older_than(self, max_age_seconds):
+        """Smaže z disku stránky, které nebyly dlouho změněny (úklid po starých sezeních)."""
+        limit = time.time() - max_age_seconds
+        for path in self.directory.glob("*/*"):
+            try:
+                if path.stat().st_mtime < limit:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def _remember(self, key, content):
+        with self._lock:
+            if key in self._hot:
+                self._hot.move_to_end(key)
+                return
+            # Stránky větší než celý rozpočet v paměti nedržíme
+            if len(content) > self.memory_budget:
+                return
+            self._hot[key] = content
+            self._hot_bytes += len(content)
+            self._evict()
+
+    def _evict(self):
+        while self._hot_bytes > self.memory_budget and self._hot:
+            _, content = self._hot.popitem(last=False)
+            self._hot_bytes -= len(content)
@@ -0,0 +1,281 @@
+"""Lokální adresář partnerů pro kontrolu a doplnění IČO/DIČ bez volání API.
+
+Index se sestaví z exportu registru (např. ARES v CSV) nebo z exportu
+adresáře FlexiBee (CSV nebo XML) do SQLite souboru s indexy podle IČO,
+DIČ a normalizovaného názvu. Čtení vstupu i zápis probíhají proudově,
+takže sestavení ani dotazy nevyžadují držet adresář v paměti.
+
+Sestavení z příkazové řádky:
+    python partner_index.py soubor.csv [soubor2.xml ...]
+"""
+import xml.etree.ElementTree as ET
+from pathlib import Path
+import unicodedata
+import threading
+import sqlite3
+import csv
+import io
+import os
+import re
+import sys
+
+PARTNER_INDEX_DB = Path(os.getenv("PARTNER_INDEX_DB", "partners.sqlite3"))
+
+# Možné názvy sloupců v exportech (porovnává se bez diakritiky a velikosti písmen)
+ICO_COLUMNS = ["ico", "ic", "ic_osoby", "identifikacni_cislo"]
+DIC_COLUMNS = ["dic", "vat_id", "danove_identifikacni_cislo"]
+NAME_COLUMNS = ["nazev", "nazev_firmy", "obchodni_jmeno", "obchodnijmeno", "obchodni_firma", "firma", "nazfirmy", "name"]
+
+# Právní formy se při porovnávání názvů ignorují
+LEGAL_FORMS = re.compile(r"\b(s\s*r\s*o|spol|a\s*s|v\s*o\s*s|k\s*s|z\s*s|o\s*p\s*s|se|gmbh|ltd|inc)\b")
+
+INSERT_BATCH = 10000
+
+def normalize_ico(value):
+    """Vrátí IČO jako 8 číslic (doplněné zleva nulami), nebo None."""
+    digits = re.sub(r"\D", "", str(value or ""))
+    if not digits or len(digits) > 8:
+        return None
+    return digits.zfill(8)
+
+def ico_checksum_valid(ico):
+    """Ověří kontrolní číslici IČO (vážený součet modulo 11)."""
+    ico = normalize_ico(ico)
+    if not ico:
+        return False
+    total = sum(int(digit) * weight for digit, weight in zip(ico[:7], range(8, 1, -1)))
+    return (11 - total % 11) % 10 == int(ico[7])
+
+def normalize_dic(value):
+    """Vrátí DIČ velkými písmeny bez mezer, nebo None."""
+    dic = re.sub(r"[\s\xa0-]", "", str(value or "")).upper()
+    return dic or None
+
+def _strip_diacritics(value):
+    value = unicodedata.normalize("NFKD", str(value or ""))
+    return "".join(c for c in value if not unicodedata.combining(c)).lower()
+
+def normalize_name(value):
+    """Normalizuje název firmy pro porovnání (bez diakritiky, interpunkce a právní formy)."""
+    name = re.sub(r"[^\w\s]", " ", _strip_diacritics(value))
+    name = LEGAL_FORMS.sub(" ", name)
+    name = " ".join(name.split())
+    return name or None
+
+def _column_key(header):
+    return re.sub(r"[^a-z0-9]+", "_", _strip_diacritics(header)).strip("_")
+
+def _find_column(headers, candidates):
+    for header in headers:
+        if _column_key(header) in candidates:
+            return header
+    return None
+
+def iter_csv_records(text_stream):
+    """Načítá záznamy (ico, dic, name) z CSV s automatickou detekcí oddělovače a sloupců."""
+    sample = text_stream.read(65536)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(_chain_sample(sample, text_stream), dialect)
+
+    headers = next(reader, None)
+    if not headers:
+        return
+    ico_col = _find_column(headers, ICO_COLUMNS)
+    dic_col = _find_column(headers, DIC_COLUMNS)
+    name_col = _find_column(headers, NAME_COLUMNS)
+    if not ico_col and not dic_col:
+        raise ValueError("V CSV nebyl nalezen sloupec s IČO ani DIČ.")
+
+    ico_idx = headers.index(ico_col) if ico_col else None
+    dic_idx = headers.index(dic_col) if dic_col else None
+    name_idx = headers.index(name_col) if name_col else None
+    for row in reader:
+        def cell(idx):
+            return row[idx] if idx is not None and idx < len(row) else None
+        yield cell(ico_idx), cell(dic_idx), cell(name_idx)
+
+def _chain_sample(sample, text_stream):
+    """Vrátí řádky ze vzorku použitého pro detekci formátu a zbytku souboru."""
+    rest = text_stream.readline()
+    yield from io.StringIO(sample + rest)
+    yield from text_stream
+
+def iter_flexibee_xml_records(binary_stream):
+    """Načítá záznamy (ico, dic, name) z XML exportu adresáře FlexiBee (winstrom/adresar)."""
+    root = None
+    for event, elem in ET.iterparse(binary_stream, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event == "end" and elem.tag == "adresar":
+            yield elem.findtext("ic"), elem.findtext("dic"), elem.findtext("nazev")
+            # Zpracované záznamy odpojíme od kořene, aby paměť nerostla s velikostí souboru
+            root.clear()
+
+def iter_records(path_or_file, filename=None):
+    """Vybere čtečku podle přípony souboru. Akceptuje cestu nebo binární soubor."""
+    filename = str(filename or path_or_file)
+    binary = open(path_or_file, "rb") if isinstance(path_or_file, (str, Path)) else path_or_file
+    try:
+        if filename.lower().endswith(".xml"):
+            yield from iter_flexibee_xml_records(binary)
+        else:
+            yield from iter_csv_records(io.TextIOWrapper(binary, encoding="utf-8-sig", errors="replace", newline=""))
+    finally:
+        if binary is not path_or_file:
+            binary.close()
+
+def build_index(sources, db_path=None):
+    """Sestaví index z jednoho nebo více zdrojů [(cesta_nebo_soubor, název), ...].
+    Index se staví do dočasného souboru a teprve po dokončení nahradí původní.
+    Vrací počet uložených záznamů.
+    """
+    db_path = Path(db_path or PARTNER_INDEX_DB)
+    tmp_path = db_path.with_suffix(".building")
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    conn = sqlite3.connect(str(tmp_path))
+    count = 0
+    try:
+        conn.executescript("""
+            PRAGMA journal_mode=OFF;
+            PRAGMA synchronous=OFF;
+            CREATE TABLE partners (
+                ico INTEGER,
+                dic TEXT,
+                name TEXT,
+                norm_name TEXT
+            );
+        """)
+        batch = []
+        for source, filename in sources:
+            for ico, dic, name in iter_records(source, filename):
+                ico = normalize_ico(ico)
+                dic = normalize_dic(dic)
+                if not ico and not dic:
+                    continue
+                name = (name or "").strip() or None
+                # IČO ukládáme jako číslo (kompaktnější než text, nuly zleva se doplní při čtení)
+                batch.append((int(ico) if ico else None, dic, name, normalize_name(name)))
+                if len(batch) >= INSERT_BATCH:
+                    conn.executemany("INSERT INTO partners VALUES (?, ?, ?, ?)", batch)
+                    count += len(batch)
+                    batch = []
+        if batch:
+            conn.executemany("INSERT INTO partners VALUES (?, ?, ?, ?)", batch)
+            count += len(batch)
+
+        # Indexy až po načtení dat (výrazně rychlejší než průběžná údržba)
+        conn.executescript("""
+            CREATE INDEX partners_ico ON partners (ico);
+            CREATE INDEX partners_dic ON partners (dic);
+            CREATE INDEX partners_name ON partners (norm_name);
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, db_path)
+    return count
+
+class PartnerIndex:
+    """Dotazy do sestaveného indexu (jen pro čtení, sdílitelné mezi vlákny)."""
+
+    def __init__(self, db_path=None):
+        self.db_path = Path(db_path or PARTNER_INDEX_DB)
+        self._conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._count = None
+
+    def _query(self, where, value):
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT ico, dic, name FROM partners WHERE {where} = ? LIMIT 2", (value,)
+            ).fetchall()
+        return [{"ico": str(ico).zfill(8) if ico is not None else None, "dic": dic, "name": name}
+                for ico, dic, name in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def count(self):
+        """Vrátí počet záznamů (index je jen pro čtení, hodnota se počítá jednou)."""
+        with self._lock:
+            if self._count is None:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM partners").fetchone()[0]
+            return self._count
+
+    def lookup_ico(self, ico):
+        ico = normalize_ico(ico)
+        rows = self._query("ico", int(ico)) if ico else []
+        return rows[0] if rows else None
+
+    def lookup_dic(self, dic):
+        dic = normalize_dic(dic)
+        rows = self._query("dic", dic) if dic else []
+        return rows[0] if rows else None
+
+    def lookup_name(self, name):
+        """Vyhledá partnera podle normalizovaného názvu (jen jednoznačná shoda)."""
+        name = normalize_name(name)
+        rows = self._query("norm_name", name) if name else []
+        return rows[0] if len(rows) == 1 else None
+
+def check_partner_data(data, index=None):
+    """Zkontroluje a doplní údaje partnera v extrahovaných datech.
+    Ověří kontrolní součet IČO a (je-li k dispozici index) doplní chybějící
+    název, IČO a DIČ podle adresáře. Vrací seznam upozornění pro uživatele.
+    """
+    warnings = []
+    ico = normalize_ico(data.get("partner_ico"))
+    ico_valid = bool(ico) and ico_checksum_valid(ico)
+    if data.get("partner_ico") and not ico_valid:
+        warnings.append(f"IČO {data['partner_ico']} nemá platný kontrolní součet.")
+
+    if index is None:
+        return warnings
+
+    # Dohledání v pořadí IČO (jen platné) -> DIČ -> název
+    record = None
+    if ico_valid:
+        record = index.lookup_ico(ico)
+    if record is None and data.get("partner_vat_id"):
+        record = index.lookup_dic(data["partner_vat_id"])
+    if record is None and data.get("partner_name") and not data.get("partner_ico") and not data.get("partner_vat_id"):
+        record = index.lookup_name(data["partner_name"])
+    if record is None:
+        if ico_valid or data.get("partner_vat_id"):
+            warnings.append("Partner nebyl nalezen v adresáři.")
+        return warnings
+
+    if record["ico"] and record["ico"] != ico:
+        if data.get("partner_ico") and ico_valid:
+            warnings.append(f"IČO neodpovídá adresáři ({record['ico']}).")
+        else:
+            if data.get("partner_ico"):
+                warnings.append(f"IČO opraveno podle adresáře na {record['ico']}.")
+            data["partner_ico"] = record["ico"]
+    if record["dic"] and record["dic"] != normalize_dic(data.get("partner_vat_id")):
+        if data.get("partner_vat_id"):
+            warnings.append(f"DIČ neodpovídá adresáři ({record['dic']}).")
+        else:
+            data["partner_vat_id"] = record["dic"]
+    if record["name"] and not data.get("partner_name"):
+        data["partner_name"] = record["name"]
+
+    return warnings
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+    count = build_index([(path, path) for path in argv[1:]])
+    print(f"Index {PARTNER_INDEX_DB} sestaven: {count} záznamů.")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv))
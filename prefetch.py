@@ -0,0 +1,54 @@
+"""Spekulativní zpracování následujících položek na pozadí.
+
+Během ruční kontroly se aktuální a několik dalších položek analyzuje ve
+vláknech, aby po kliknutí na „Schválit a další“ byla data připravená.
+Úlohy mimo aktuální okno (uživatel přeskočil jinam) se ruší.
+Úlohy běží mimo skript Streamlitu, proto nesmí volat st.*.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+class Prefetcher:
+    """Sleduje rozpracované úlohy jednoho sezení nad sdíleným executorem."""
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, key, fn, *args):
+        """Naplánuje úlohu, pokud pro daný klíč ještě neběží."""
+        with self._lock:
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(fn, *args)
+
+    def cancel_except(self, keep_keys):
+        """Zruší úlohy mimo keep_keys. Již běžící úlohu nelze přerušit,
+        její výsledek se ale zahodí.
+        """
+        keep_keys = set(keep_keys)
+        with self._lock:
+            for key in list(self._futures):
+                if key not in keep_keys:
+                    self._futures.pop(key).cancel()
+
+    def pending(self):
+        """Vrátí klíče úloh, které ještě nejsou hotové."""
+        with self._lock:
+            return {key for key, future in self._futures.items() if not future.done()}
+
+    def pop_finished(self):
+        """Vrátí a odebere dokončené úlohy jako seznam (klíč, výsledek, výjimka)."""
+        finished = []
+        with self._lock:
+            for key, future in list(self._futures.items()):
+                if future.done():
+                    del self._futures[key]
+                    if future.cancelled():
+                        continue
+                    error = future.exception()
+                    finished.append((key, None if error else future.result(), error))
+        return finished
+
+def create_executor(max_workers=2):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
@@ -0,0 +1,196 @@
+"""Worker pro zpracování faktur na pozadí (mimo Streamlit).
+
+Spuštění:
+    python worker.py
+
+UI (app.py) úlohy pouze zakládá do lokální fronty v SQLite a dotazuje se
+na jejich výsledky. Worker běží jako samostatný proces, takže rozpracovaná
+dávka pokračuje i po zavření prohlížeče a kliknutí v UI nečekají na Gemini.
+Worker také kontroluje stav dávkových úloh (batch_jobs.py) a přebírá jejich
+výsledky, UI pak jen čte lokální databázi.
+"""
+from google import genai
+from dotenv import load_dotenv
+import sqlite3
+import json
+import os
+import time
+from pathlib import Path
+
+import extraction
+import batch_jobs
+from page_store import PageStore
+
+QUEUE_DB = Path(os.getenv("WORKER_QUEUE_DB", "worker_queue.sqlite3"))
+POLL_INTERVAL = 0.5
+# Worker je považován za živý, pokud se ozval během posledních N sekund
+# (heartbeat se zapisuje mezi úlohami, jedna extrakce může trvat déle)
+HEARTBEAT_TIMEOUT = 60
+
+def connect(db_path=None):
+    """Otevře (a případně inicializuje) databázi fronty úloh."""
+    conn = sqlite3.connect(str(db_path or QUEUE_DB), timeout=30)
+    conn.row_factory = sqlite3.Row
+    # WAL umožní UI číst výsledky, zatímco worker zapisuje
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            mode TEXT,
+            name TEXT,
+            mimetype TEXT,
+            size INTEGER,
+            priority INTEGER NOT NULL DEFAULT 0,
+            payload BLOB,
+            status TEXT NOT NULL DEFAULT 'pending',
+            result TEXT,
+            error TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, created);
+        CREATE TABLE IF NOT EXISTS heartbeat (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            ts REAL NOT NULL,
+            pid INTEGER
+        );
+    """)
+    return conn
+
+# --- API pro UI ---
+
+def enqueue(conn, job_id, kind, payload, mode=None, name=None, mimetype=None, size=None, priority=0):
+    """Založí úlohu ve frontě. Existující úloha se stejným ID se nepřepisuje.
+    Úlohy s vyšší prioritou (např. ruční analýza aktuální položky) předbíhají dávku.
+    """
+    now = time.time()
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO jobs (id, kind, mode, name, mimetype, size, priority, payload, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, mode, name, mimetype, size, priority, payload, now, now)
+        )
+
+def get_jobs(conn, job_ids):
+    """Vrátí stav úloh jako {id: {"status", "result", "error"}} (jen existující úlohy)."""
+    jobs = {}
+    job_ids = list(job_ids)
+    # SQLite má limit na počet parametrů, dotazujeme se po dávkách
+    for start in range(0, len(job_ids), 500):
+        chunk = job_ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT id, status, result, error FROM jobs WHERE id IN ({placeholders})", chunk
+        ).fetchall()
+        for row in rows:
+            jobs[row["id"]] = {
+                "status": row["status"],
+                "result": json.loads(row["result"]) if row["result"] else None,
+                "error": row["error"]
+            }
+    return jobs
+
+def delete_jobs(conn, job_ids, only_pending=False):
+    """Smaže úlohy (např. po převzetí výsledku nebo při zastavení dávky)."""
+    job_ids = list(job_ids)
+    with conn:
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            query = f"DELETE FROM jobs WHERE id IN ({placeholders})"
+            if only_pending:
+                query += " AND status = 'pending'"
+            conn.execute(query, chunk)
+
+def worker_alive(conn):
+    """Zjistí, zda worker v nedávné době zapsal heartbeat."""
+    row = conn.execute("SELECT ts FROM heartbeat WHERE id = 1").fetchone()
+    return bool(row) and time.time() - row["ts"] < HEARTBEAT_TIMEOUT
+
+# --- Smyčka workeru ---
+
+def claim_next_job(conn):
+    """Atomicky převezme nejstarší čekající úlohu s nejvyšší prioritou."""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'pending' ORDER BY priority DESC, created LIMIT 1"
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                (time.time(), row["id"])
+            )
+    return row
+
+def run_job(client, store, job):
+    """Provede jednu úlohu a vrátí výsledek serializovatelný do JSON."""
+    if job["kind"] == "extract":
+        data = extraction.extract_invoice_data(client, bytes(job["payload"]), job["mode"])
+        return extraction.apply_date_fallbacks(data)
+    if job["kind"] == "pdf":
+        # Stránky se zapisují přímo do sdíleného úložiště, výsledek obsahuje jen jejich klíče
+        return extraction.pdf_to_images(job["name"], job["size"], bytes(job["payload"]), store)
+    raise ValueError(f"Neznámý typ úlohy: {job['kind']}")
+
+def finish_job(conn, job_id, result=None, error=None):
+    """Uloží výsledek úlohy a uvolní vstupní data."""
+    status = "error" if error else "done"
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, payload = NULL, updated = ? WHERE id = ?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+             error, time.time(), job_id)
+        )
+
+def write_heartbeat(conn):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO heartbeat (id, ts, pid) VALUES (1, ?, ?)",
+            (time.time(), os.getpid())
+        )
+
+def main():
+    load_dotenv()
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        print("Prosím, nastavte GOOGLE_API_KEY v souboru .env.")
+        return 1
+    client = genai.Client(api_key=api_key)
+    # Worker stránky jen zapisuje, v paměti je držet nepotřebuje
+    store = PageStore(memory_budget=0)
+
+    conn = connect()
+    batch_conn = batch_jobs.connect()
+    # Úlohy rozpracované předchozím (spadlým) workerem vrátíme do fronty
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    print(f"Worker běží (fronta: {QUEUE_DB}). Ukončení: Ctrl+C")
+    try:
+        while True:
+            write_heartbeat(conn)
+            # Stav dávek se u poskytovatele zjišťuje jen jednou za STATUS_CHECK_INTERVAL
+            for error in batch_jobs.refresh_jobs(batch_conn, client):
+                print(f"Chyba dávkového zpracování: {error}")
+            job = claim_next_job(conn)
+            if not job:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            print(f"Zpracovávám {job['kind']}: {job['name']}")
+            try:
+                finish_job(conn, job["id"], result=run_job(client, store, job))
+            except Exception as e:
+                print(f"Chyba při zpracování {job['name']}: {e}")
+                finish_job(conn, job["id"], error=str(e))
+    except KeyboardInterrupt:
+        print("Worker ukončen.")
+    finally:
+        conn.close()
+        batch_conn.close()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())